@@ -1,27 +1,86 @@
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Query
 from pydantic import BaseModel
-from sqlalchemy import create_engine, Column, Integer, String, VARCHAR
+from sqlalchemy import Column, Integer, String, VARCHAR, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, Session
 import os
 from dotenv import load_dotenv
+from observability import Metrics, instrument, get_logger
+from common import Registration, async_database_url, pool_options
 import uuid
 import hashlib
+import hmac
+import base64
+import json
+import time
 import httpx
+import asyncio
+from collections import OrderedDict
+from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from passlib.context import CryptContext
 
 # Load environment variables from .env file
 load_dotenv()
 
 # Initialize FastAPI
 app = FastAPI()
+logger = get_logger("auth_service")
+metrics = Metrics()
+instrument(app, metrics)
+registration = Registration("auth_service", metrics, logger)
+
 
 # SQLAlchemy setup
-DATABASE_URL = os.environ.get('AUTH_DATABASE_URL')
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+DATABASE_URL = async_database_url(os.environ.get('AUTH_DATABASE_URL'))
+engine = create_async_engine(DATABASE_URL, **pool_options(DATABASE_URL))
+SessionLocal = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
 
 
+# Signing keys for session tokens as "kid:secret,kid:secret". The first key signs; to rotate,
+# add the new key to the gateway's AUTH_TOKEN_KEYS first, then put it first here, and drop the
+# old key everywhere once AUTH_TOKEN_TTL has passed.
+def parse_token_keys(value: str):
+    keys = []
+    for entry in value.split(","):
+        kid, _, secret = entry.strip().partition(":")
+        if kid and secret:
+            keys.append((kid, secret.encode()))
+    return keys
+
+
+TOKEN_KEYS = parse_token_keys(os.environ.get('AUTH_TOKEN_KEYS', ''))
+if not TOKEN_KEYS:
+    raise RuntimeError("AUTH_TOKEN_KEYS is not set")
+TOKEN_TTL = int(os.environ.get('AUTH_TOKEN_TTL', 3600))
+
+# Password hashing: the default KDF and its cost are configurable. Hashes made with other
+# settings, and legacy unsalted SHA-512 hashes, are upgraded the next time their user logs in.
+PASSWORD_KDF = os.environ.get('PASSWORD_KDF', 'scrypt')
+password_context = CryptContext(
+    schemes=["scrypt", "pbkdf2_sha256", "hex_sha512"],
+    default=PASSWORD_KDF,
+    deprecated="auto",
+    scrypt__rounds=int(os.environ.get('PASSWORD_SCRYPT_ROUNDS', 14)),
+    pbkdf2_sha256__rounds=int(os.environ.get('PASSWORD_PBKDF2_ROUNDS', 600000)),
+)
+
+# hashlib releases the GIL while hashing, so a thread pool keeps the event loop free.
+# Once PASSWORD_QUEUE_LIMIT jobs are waiting or running, new ones are refused with a 503.
+PASSWORD_WORKERS = int(os.environ.get('PASSWORD_WORKERS', os.cpu_count() or 1))
+PASSWORD_QUEUE_LIMIT = int(os.environ.get('PASSWORD_QUEUE_LIMIT', 64))
+password_pool = ThreadPoolExecutor(max_workers=PASSWORD_WORKERS, thread_name_prefix="password")
+password_jobs = 0
+
+# Public profile cache; entries expire after USER_CACHE_TTL seconds so other instances' writes show up
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 10000))
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', 60.0))
+# Most ids accepted by one bulk lookup
+MAX_BULK_USERS = int(os.environ.get('MAX_BULK_USERS', 500))
+
+
 # Pydantic model for user registration
 class UserCreate(BaseModel):
     username: str
@@ -34,6 +93,15 @@ class UserLogin(BaseModel):
     password: str
 
 
+# Pydantic model for the public part of a user, never includes the password hash
+class UserPublic(BaseModel):
+    id: str
+    username: str
+
+    class Config:
+        orm_mode = True
+
+
 # SQLAlchemy model for user
 class User(Base):
     __tablename__ = "users"
@@ -43,60 +111,179 @@ class User(Base):
 
 
 # Create tables in the database
-Base.metadata.create_all(bind=engine)
+async def init_db():
+    async with engine.begin() as connection:
+        await connection.run_sync(Base.metadata.create_all)
+
+
+class ProfileCache:
+    """Keeps public user profiles in memory.
+
+    Profiles are evicted least recently used first once more than `size` are
+    cached, and treated as missing once older than `ttl` seconds. Writes to a
+    user invalidate its entry on this instance; the TTL bounds how long other
+    instances keep serving the old profile.
+    """
+
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self.profiles = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, user_id: str):
+        entry = self.profiles.get(user_id)
+        if entry is None or entry[0] < time.monotonic():
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        self.profiles.move_to_end(user_id)
+        return entry[1]
+
+    def put(self, profile: UserPublic):
+        if self.size <= 0:
+            return
+        self.profiles[profile.id] = (time.monotonic() + self.ttl, profile)
+        self.profiles.move_to_end(profile.id)
+        while len(self.profiles) > self.size:
+            self.profiles.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def invalidate(self, user_id: str):
+        self.profiles.pop(user_id, None)
+
+    def info(self):
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "hit_rate": self.stats["hits"] / lookups if lookups else None,
+            "profiles": len(self.profiles),
+            "size": self.size,
+            "ttl": self.ttl,
+        }
+
+
+profile_cache = ProfileCache(USER_CACHE_SIZE, USER_CACHE_TTL)
 
 
 # Password hashing
 def hash_password(password):
-    # Hash the password using SHA-512
-    hashed_password = hashlib.sha512(password.encode()).hexdigest()
-    return hashed_password
+    return password_context.hash(password)
 
 
-# Function to verify passwords
+# Function to verify passwords; also returns a new hash when the stored one is outdated
 def verify_password(plain_password, hashed_password):
-    # Hash the plain password using SHA-512 and compare with the stored hashed password
-    return hashed_password == hashlib.sha512(plain_password.encode()).hexdigest()
+    return password_context.verify_and_update(plain_password, hashed_password)
+
+
+# Run hashing on the password pool, shedding load once too much work is queued
+async def run_password_job(function, *args):
+    global password_jobs
+    if password_jobs >= PASSWORD_QUEUE_LIMIT:
+        raise HTTPException(status_code=503, detail="Too many password requests, try again later",
+                            headers={"Retry-After": "1"})
+    password_jobs += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(password_pool, function, *args)
+    finally:
+        password_jobs -= 1
+
+
+def b64url_encode(data: bytes):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+# Issue an HS256 JWT for the user, so the gateway can verify it without calling us
+def issue_token(user_id: str):
+    kid, key = TOKEN_KEYS[0]
+    now = int(time.time())
+    header = {"alg": "HS256", "typ": "JWT", "kid": kid}
+    claims = {"sub": user_id, "iat": now, "exp": now + TOKEN_TTL, "jti": uuid.uuid4().hex}
+    signing_input = ".".join(b64url_encode(json.dumps(part, separators=(",", ":")).encode())
+                             for part in (header, claims))
+    signature = hmac.new(key, signing_input.encode(), hashlib.sha256).digest()
+    return f"{signing_input}.{b64url_encode(signature)}", claims["exp"]
 
 
 # Function to create a new user
-def create_user(db_session, user: UserCreate):
+async def create_user(db_session, user: UserCreate):
     # Check if the username already exists
-    existing_user = db_session.query(User).filter(User.username == user.username).first()
+    existing_user = await db_session.scalar(select(User).where(User.username == user.username))
     if existing_user:
         raise HTTPException(status_code=400, detail="Username already registered")
-    hashed_password = hash_password(user.password)
+    # Hand the connection back while waiting for the password pool
+    await db_session.commit()
+    hashed_password = await run_password_job(hash_password, user.password)
     db_user = User(id=str(uuid.uuid4()),
                    username=user.username,
                    hashed_password=hashed_password)
     db_session.add(db_user)
-    db_session.commit()
-    db_session.refresh(db_user)
+    try:
+        await db_session.commit()
+    except IntegrityError:
+        # Registered by a concurrent request while the password was hashing
+        await db_session.rollback()
+        raise HTTPException(status_code=400, detail="Username already registered")
+    profile_cache.invalidate(db_user.id)
     return db_user
 
 
 # Function to get user data
-def get_user(db_session, user_id: str):
-    return db_session.query(User).filter(User.id == user_id).first()
+async def get_user(db_session, user_id: str):
+    profile = profile_cache.get(user_id)
+    if profile is None:
+        user = await db_session.scalar(select(User).where(User.id == user_id))
+        if user is None:
+            return None
+        profile = UserPublic.from_orm(user)
+        profile_cache.put(profile)
+    return profile
+
+
+# Resolve many users at once: cached profiles plus one query for the rest, in request order
+async def get_users(db_session, user_ids: List[str]):
+    profiles = {}
+    missing = []
+    for user_id in dict.fromkeys(user_ids):
+        profile = profile_cache.get(user_id)
+        if profile is None:
+            missing.append(user_id)
+        else:
+            profiles[user_id] = profile
+    if missing:
+        for user in await db_session.scalars(select(User).where(User.id.in_(missing))):
+            profile = UserPublic.from_orm(user)
+            profile_cache.put(profile)
+            profiles[profile.id] = profile
+    return [profiles[user_id] for user_id in dict.fromkeys(user_ids) if user_id in profiles]
 
 
 # Function to authenticate user
-def authenticate_user(db_session, username: str, password: str):
-    user = db_session.query(User).filter(User.username == username).first()
-    if not user or not verify_password(password, user.hashed_password):
+async def authenticate_user(db_session, username: str, password: str):
+    user = (await db_session.execute(
+        select(User.id, User.hashed_password).where(User.username == username))).first()
+    if not user:
+        return None
+    # Hand the connection back while waiting for the password pool
+    await db_session.commit()
+    valid, new_hash = await run_password_job(verify_password, password, user.hashed_password)
+    if not valid:
         return None
+    if new_hash:
+        await db_session.execute(update(User).where(User.id == user.id).values(hashed_password=new_hash))
+        await db_session.commit()
     return user
 
 
 # API endpoint for user registration
-@app.post("/register-user/")
+@app.post("/register-user/", response_model=UserPublic)
 async def register(user: UserCreate):
     db = SessionLocal()
     try:
-        db_user = create_user(db, user)
-        return db_user
+        db_user = await create_user(db, user)
+        return UserPublic.from_orm(db_user)
     finally:
-        db.close()
+        await db.close()
 
 
 # API endpoint for user login and authentication
@@ -104,41 +291,56 @@ async def register(user: UserCreate):
 async def login(user: UserLogin):
     db = SessionLocal()
     try:
-        user = authenticate_user(db, user.username, user.password)
+        user = await authenticate_user(db, user.username, user.password)
         if not user:
             raise HTTPException(status_code=401, detail="Invalid credentials")
-        # Return user ID along with authentication response
-        return {"user_id": user.id}
+        # Return user ID along with a signed session token
+        token, expires_at = issue_token(user.id)
+        return {"user_id": user.id, "token": token, "expires_at": expires_at}
     finally:
-        db.close()
+        await db.close()
 
 
 # API endpoint to get user data
-@app.get("/user/{user_id}")
+@app.get("/user/{user_id}", response_model=UserPublic)
 async def get_user_data(user_id: str):
     db = SessionLocal()
     try:
-        user = get_user(db, user_id)
+        user = await get_user(db, user_id)
+        if user is None:
+            raise HTTPException(status_code=404, detail="User not found")
         return user
     finally:
-        db.close()
+        await db.close()
 
 
-async def make_http_request():
-    async with httpx.AsyncClient() as client:
-        payload = {"service_name": "auth_service"}  # Add service_name field with a value
-        response = await client.post(os.environ.get('GATEWAY_URL'), json=payload)
+# API endpoint to look up many users in one call: /users?ids=a&ids=b. Unknown ids are left out.
+@app.get("/users", response_model=List[UserPublic])
+async def get_users_data(ids: List[str] = Query(...)):
+    if len(ids) > MAX_BULK_USERS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BULK_USERS} ids per request")
+    db = SessionLocal()
+    try:
+        return await get_users(db, ids)
+    finally:
+        await db.close()
 
-        if response.status_code != 200:
-            raise HTTPException(status_code=500,
-                                detail=f"Failed to make HTTP request, status code: {response.status_code}")
 
-        print("successfully registered")
+# API endpoint reporting the profile cache hit rate and size
+@app.get("/cache-stats")
+async def cache_stats():
+    return profile_cache.info()
 
 
 @app.on_event("startup")
 async def startup_event():
-    await make_http_request()
+    await init_db()
+    await registration.start()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    password_pool.shutdown(wait=False)
 
 
 if __name__ == "__main__":
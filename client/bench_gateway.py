@@ -0,0 +1,144 @@
+import argparse
+import asyncio
+import importlib.util
+import os
+import sys
+import threading
+import time
+
+import httpx
+import uvicorn
+from fastapi import FastAPI
+
+from bench_tokens import BENCH_KEYS, sign_token
+
+# Throughput benchmark for the gateway against local stand-in backends.
+#
+#   python client/bench_gateway.py
+#   git show HEAD~1:gateway.py > /tmp/gateway_before.py
+#   python client/bench_gateway.py --gateway /tmp/gateway_before.py
+#
+# The stand-in register service and message service run in this process on
+# their own event loops, the backend sleeps for --latency ms per request.
+# Rate limiting is off for the run, so the figures measure the proxy path only.
+
+HOST = "127.0.0.1"
+
+
+def stand_in_register(backend_url):
+    register = FastAPI()
+
+    @register.get("/get_service/{service_name}")
+    async def get_service(service_name: str):
+        return {"address": backend_url, "is_active": True}
+
+    return register
+
+
+def stand_in_backend(latency):
+    backend = FastAPI()
+
+    @backend.get("/get-messages/{conversation_id}")
+    async def get_messages(conversation_id: str):
+        await asyncio.sleep(latency)
+        return [{"id": "1", "conversation_id": conversation_id, "content": "hi"}]
+
+    @backend.post("/send-message/")
+    async def send_message():
+        await asyncio.sleep(latency)
+        return {"id": "1"}
+
+    return backend
+
+
+def serve(app, port):
+    server = uvicorn.Server(uvicorn.Config(app, host=HOST, port=port, log_level="error"))
+    server.install_signal_handlers = lambda: None
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    return server
+
+
+def load_gateway(path):
+    # The gateway imports its sibling modules
+    sys.path.insert(0, os.path.dirname(os.path.abspath(path)))
+    spec = importlib.util.spec_from_file_location("bench_gateway_target", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.app
+
+
+async def hammer(url, requests_total, concurrency, headers=None):
+    latencies = []
+    errors = 0
+    queue = asyncio.Queue()
+    for _ in range(requests_total):
+        queue.put_nowait(None)
+
+    async with httpx.AsyncClient(limits=httpx.Limits(max_connections=concurrency),
+                                 headers=headers, timeout=60) as client:
+        async def worker():
+            nonlocal errors
+            while not queue.empty():
+                queue.get_nowait()
+                started = time.perf_counter()
+                response = await client.get(url)
+                latencies.append(time.perf_counter() - started)
+                if response.status_code != 200:
+                    errors += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": requests_total,
+        "errors": errors,
+        "elapsed": elapsed,
+        "rps": requests_total / elapsed,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99) - 1] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Gateway throughput benchmark")
+    parser.add_argument("--gateway", default=os.path.join(os.path.dirname(__file__), "..", "gateway.py"))
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=20, help="backend latency in ms")
+    parser.add_argument("--port", type=int, default=18000)
+    args = parser.parse_args()
+
+    register_port, backend_port, gateway_port = args.port, args.port + 1, args.port + 2
+    os.environ["REGISTER_SERVICE_URL"] = f"http://{HOST}:{register_port}"
+    os.environ["AUTH_TOKEN_KEYS"] = BENCH_KEYS
+    # Every request carries one user's token, the read bucket would answer most of them with 429
+    os.environ["GATEWAY_RATE_LIMIT_READ_RATE"] = "0"
+    headers = {"Authorization": f"Bearer {sign_token('bench-user')}"}
+
+    servers = [
+        serve(stand_in_backend(args.latency / 1000), backend_port),
+        serve(stand_in_register(f"http://{HOST}:{backend_port}"), register_port),
+        serve(load_gateway(args.gateway), gateway_port),
+    ]
+
+    url = f"http://{HOST}:{gateway_port}/get-messages/bench"
+    asyncio.run(hammer(url, min(args.requests, 100), args.concurrency, headers))  # warm up
+    result = asyncio.run(hammer(url, args.requests, args.concurrency, headers))
+
+    print(f"gateway:     {os.path.abspath(args.gateway)}")
+    print(f"requests:    {result['requests']} ({result['errors']} errors), concurrency {args.concurrency}")
+    print(f"throughput:  {result['rps']:.1f} req/s")
+    print(f"latency:     p50 {result['p50_ms']:.1f} ms, p99 {result['p99_ms']:.1f} ms")
+
+    for server in servers:
+        server.should_exit = True
+    sys.exit(1 if result["errors"] else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+import argparse
+import base64
+import hashlib
+import hmac
+import importlib.util
+import json
+import os
+import sys
+import time
+import timeit
+
+# Per-request cost of verifying a session token in the gateway.
+#
+#   python client/bench_tokens.py
+#
+# Signs a token the way auth_service does and times gateway.verify_token on it,
+# plus the rejection paths for a bad signature and an unknown key id.
+
+BENCH_KEYS = "bench:bench-secret,old:old-secret"
+
+
+def b64url_encode(data: bytes):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def sign_token(user_id, kid="bench", secret=b"bench-secret", ttl=3600):
+    now = int(time.time())
+    header = {"alg": "HS256", "typ": "JWT", "kid": kid}
+    claims = {"sub": user_id, "iat": now, "exp": now + ttl, "jti": os.urandom(16).hex()}
+    signing_input = ".".join(b64url_encode(json.dumps(part, separators=(",", ":")).encode())
+                             for part in (header, claims))
+    signature = hmac.new(secret, signing_input.encode(), hashlib.sha256).digest()
+    return f"{signing_input}.{b64url_encode(signature)}"
+
+
+def load_gateway(path):
+    # The gateway imports its sibling modules
+    sys.path.insert(0, os.path.dirname(os.path.abspath(path)))
+    spec = importlib.util.spec_from_file_location("bench_tokens_target", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Session token verification benchmark")
+    parser.add_argument("--gateway", default=os.path.join(os.path.dirname(__file__), "..", "gateway.py"))
+    parser.add_argument("--number", type=int, default=200000)
+    args = parser.parse_args()
+
+    os.environ["AUTH_TOKEN_KEYS"] = BENCH_KEYS
+    gateway = load_gateway(args.gateway)
+
+    token = sign_token("bench-user")
+    cases = {
+        "valid": token,
+        "valid, rotated key": sign_token("bench-user", kid="old", secret=b"old-secret"),
+        "bad signature": token[:-4] + ("AAAA" if not token.endswith("AAAA") else "BBBB"),
+        "unknown key id": sign_token("bench-user", kid="gone", secret=b"gone"),
+    }
+    assert gateway.verify_token(cases["valid"])["sub"] == "bench-user"
+    assert gateway.verify_token(cases["valid, rotated key"])["sub"] == "bench-user"
+    assert gateway.verify_token(cases["bad signature"]) is None
+    assert gateway.verify_token(cases["unknown key id"]) is None
+
+    print(f"gateway:     {os.path.abspath(args.gateway)}")
+    for name, case in cases.items():
+        elapsed = timeit.timeit(lambda: gateway.verify_token(case), number=args.number)
+        print(f"{name + ':':<20} {elapsed / args.number * 1e6:.2f} us/verify")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+import argparse
+import asyncio
+import importlib.util
+import os
+import sys
+import tempfile
+from types import SimpleNamespace
+
+import httpx
+from fastapi import HTTPException, Response
+
+# Consistency checks for message_service's conversation resolution, run
+# against a throwaway SQLite database.
+#
+#   python client/check_conversations.py
+#
+# A message and its reply often land in the same write batch, so the
+# conversation checks mix both directions of a participant pair. A second copy
+# of the service on the same database stands in for another instance.
+
+
+def load_message_service(path, database_path, name="check_message_service"):
+    os.environ["MESSAGE_DATABASE_URL"] = f"sqlite:///{database_path}"
+    os.environ["MESSAGE_GROUP_COMMIT"] = "1"
+    # The service imports its sibling modules
+    sys.path.insert(0, os.path.dirname(os.path.abspath(path)))
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+async def check_reversed_pair_batch(service, peer):
+    # Both directions in one create_messages call
+    db = service.SessionLocal()
+    try:
+        rows = await service.create_messages(db, [
+            service.Message(user_id="a", participant_id="b", content="hi"),
+            service.Message(user_id="b", participant_id="a", content="hello"),
+        ])
+    finally:
+        await db.close()
+    assert len({row["conversation_id"] for row in rows}) == 1, rows
+
+
+async def check_reversed_pair_group_commit(service, peer):
+    # Concurrent sends in opposite directions share a group commit
+    rows = await asyncio.gather(
+        service.send_message(service.Message(user_id="p", participant_id="q", content="ping")),
+        service.send_message(service.Message(user_id="q", participant_id="p", content="pong")),
+    )
+    assert len({row["conversation_id"] for row in rows}) == 1, rows
+
+
+async def check_send_messages_reversed_pair(service, peer):
+    # Through the route, so a failure shows up the way clients see it
+    transport = httpx.ASGITransport(app=service.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://message-service") as client:
+        response = await client.post("/send-messages/", json={"messages": [
+            {"user_id": "a", "participant_id": "c", "content": "hi"},
+            {"user_id": "c", "participant_id": "a", "content": "hello"},
+            {"user_id": "a"},
+        ]})
+    assert response.status_code == 200, response.text
+    results = response.json()["results"]
+    assert [result["status"] for result in results] == [200, 200, 422], results
+    assert results[0]["message"]["conversation_id"] == results[1]["message"]["conversation_id"], results
+
+
+async def check_tail_cache_sees_peer_writes(service, peer):
+    # A cached newest page must not outlive a write made on another instance
+    request = SimpleNamespace(headers={})
+    first = await service.send_message(service.Message(user_id="t", participant_id="u", content="one"))
+    conversation_id = first["conversation_id"]
+    await service.get_messages(conversation_id, request, Response())
+    await peer.send_message(peer.Message(user_id="u", participant_id="t", content="two"))
+    page = await service.get_messages(conversation_id, request, Response())
+    assert [message["content"] for message in page["messages"]] == ["one", "two"], page
+
+
+async def check_get_messages_members_only(service, peer):
+    request = SimpleNamespace(headers={})
+    row = await service.send_message(service.Message(user_id="m", participant_id="n", content="private"))
+    page = await service.get_messages(row["conversation_id"], request, Response(), user_id="n")
+    assert [message["content"] for message in page["messages"]] == ["private"], page
+    try:
+        await service.get_messages(row["conversation_id"], request, Response(), user_id="eve")
+    except HTTPException as e:
+        assert e.status_code == 404, e
+    else:
+        raise AssertionError("a non-participant read the conversation")
+
+
+CHECKS = [
+    check_reversed_pair_batch,
+    check_reversed_pair_group_commit,
+    check_send_messages_reversed_pair,
+    check_tail_cache_sees_peer_writes,
+    check_get_messages_members_only,
+]
+
+
+async def run_checks(service, peer):
+    await service.init_db()
+    service.message_writer.start()
+    peer.message_writer.start()
+    failed = 0
+    for check in CHECKS:
+        try:
+            await check(service, peer)
+            print(f"ok      {check.__name__}")
+        except Exception as e:
+            failed += 1
+            print(f"FAILED  {check.__name__}: {e!r}")
+    await service.engine.dispose()
+    await peer.engine.dispose()
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="message_service conversation checks")
+    parser.add_argument("--service", default=os.path.join(os.path.dirname(__file__), "..", "message_service.py"))
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        database_path = os.path.join(directory, "messages.db")
+        service = load_message_service(args.service, database_path)
+        peer = load_message_service(args.service, database_path, "check_message_service_peer")
+        failed = asyncio.run(run_checks(service, peer))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
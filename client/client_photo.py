@@ -1,7 +1,12 @@
 import requests
 import base64
 import json
+import os
 import time
+
+# Session token from the gateway's /login/ response
+AUTH_HEADERS = {'Authorization': f"Bearer {os.environ.get('GATEWAY_TOKEN', '')}"}
+
 def test_upload_photo(): 
     with open("sample_image.jpg", "rb") as image_file:
         image_bytes = image_file.read()
@@ -14,11 +19,26 @@ def test_upload_photo():
         'publish_date': int(time.time())
     }
 
-    headers = {'Content-Type': 'application/json'}
+    headers = {'Content-Type': 'application/json', **AUTH_HEADERS}
     response = requests.post("http://127.0.0.1:8000/upload-photo/", json=payload, headers=headers)
 
     print(response.json())
 
+def test_upload_photo_stream():
+    # Sends the raw file, requests streams it from disk instead of loading it
+    params = {
+        'description': 'Test Description',
+        'publish_date': int(time.time())
+    }
+
+    headers = {'Content-Type': 'image/jpeg', **AUTH_HEADERS}
+    with open("sample_image.jpg", "rb") as image_file:
+        response = requests.post("http://127.0.0.1:8000/upload-photo/stream", params=params,
+                                 data=image_file, headers=headers)
+
+    print(response.json())
+
 if __name__ == "__main__":
     test_upload_photo()
+    test_upload_photo_stream()
     print("All tests passed!")
@@ -1,8 +1,12 @@
 import requests
 import base64
 import json
+import os
 import time
 
+# Session token from the gateway's /login/ response
+AUTH_HEADERS = {'Authorization': f"Bearer {os.environ.get('GATEWAY_TOKEN', '')}"}
+
 def test_upload_video(): 
     with open("IMG_8696.MOV", "rb") as video_file:
         video_bytes = video_file.read()
@@ -15,11 +19,26 @@ def test_upload_video():
         'publish_date': int(time.time())
     }
 
-    headers = {'Content-Type': 'application/json'}
+    headers = {'Content-Type': 'application/json', **AUTH_HEADERS}
     response = requests.post("http://127.0.0.1:8000/upload-video", json=payload, headers=headers)
 
     print(response.json())
 
+def test_upload_video_stream():
+    # Sends the raw file, requests streams it from disk instead of loading it
+    params = {
+        'description': 'Test Video Description',
+        'publish_date': int(time.time())
+    }
+
+    headers = {'Content-Type': 'video/quicktime', **AUTH_HEADERS}
+    with open("IMG_8696.MOV", "rb") as video_file:
+        response = requests.post("http://127.0.0.1:8000/upload-video/stream", params=params,
+                                 data=video_file, headers=headers)
+
+    print(response.json())
+
 if __name__ == "__main__":
     test_upload_video()
+    test_upload_video_stream()
     print("All tests passed!")
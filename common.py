@@ -0,0 +1,80 @@
+import asyncio
+import os
+
+import httpx
+from fastapi import HTTPException
+from sqlalchemy.engine import make_url
+
+# Shared by the database-backed services: engine settings for their database
+# URL, and registering the instance with the gateway.
+
+# Address of this instance; when set the instance registers itself and heartbeats,
+# so several instances can run behind the gateway
+SERVICE_ADDRESS = os.environ.get('SERVICE_ADDRESS')
+HEARTBEAT_INTERVAL = float(os.environ.get('HEARTBEAT_INTERVAL', 5.0))
+
+
+# Point a plain database URL at the matching asyncio driver
+def async_database_url(url: str):
+    url = make_url(url)
+    drivers = {"postgresql": "postgresql+asyncpg", "sqlite": "sqlite+aiosqlite"}
+    return url.set(drivername=drivers.get(url.get_backend_name(), url.drivername))
+
+
+# Connection pool sizing; SQLite runs without a sized pool, so it only gets pre-ping
+def pool_options(url):
+    options = {"pool_pre_ping": os.environ.get('DB_POOL_PRE_PING', '1') == '1'}
+    if url.get_backend_name() != "sqlite":
+        options.update(
+            pool_size=int(os.environ.get('DB_POOL_SIZE', 10)),
+            max_overflow=int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+            pool_timeout=float(os.environ.get('DB_POOL_TIMEOUT', 30)),
+            pool_recycle=int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+        )
+    return options
+
+
+class Registration:
+    """Registers one instance of `service_name` through the gateway.
+
+    Registering again with the instance id the registry handed out acts as a
+    heartbeat and reports the instance's load and requests in flight.
+    """
+
+    def __init__(self, service_name: str, metrics, logger):
+        self.service_name = service_name
+        self.metrics = metrics
+        self.logger = logger
+        self.instance_id = None
+
+    async def register(self):
+        async with httpx.AsyncClient() as client:
+            payload = {"service_name": self.service_name,
+                       "address": SERVICE_ADDRESS,
+                       "instance_id": self.instance_id,
+                       "load": os.getloadavg()[0],
+                       "inflight": self.metrics.inflight}
+            # Registering our own address needs the shared registry secret
+            headers = {"X-Registry-Secret": os.environ.get('REGISTRY_SECRET', '')}
+            response = await client.post(os.environ.get('GATEWAY_URL'), json=payload, headers=headers)
+
+            if response.status_code != 200:
+                raise HTTPException(status_code=500,
+                                    detail=f"Failed to make HTTP request, status code: {response.status_code}")
+
+            self.instance_id = response.json().get("instance_id")
+
+    async def send_heartbeats(self):
+        # Re-registering with our instance id keeps this instance in the registry
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            try:
+                await self.register()
+            except Exception as e:
+                self.logger.warning("heartbeat failed: %s", e)
+
+    async def start(self):
+        await self.register()
+        self.logger.info("successfully registered")
+        if SERVICE_ADDRESS:
+            asyncio.create_task(self.send_heartbeats())
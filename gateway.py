@@ -1,9 +1,20 @@
-from fastapi import FastAPI, HTTPException
-import requests
+from fastapi import FastAPI, HTTPException, Request, Depends, Query, Header
+from fastapi.responses import StreamingResponse, Response
+from starlette.background import BackgroundTask
+import asyncio
+import httpx
+import random
 import base64
+import hashlib
+import hmac
+import json
+import math
+from collections import OrderedDict, deque
+from functools import lru_cache
 from pydantic import BaseModel
 import time
-from typing import Optional
+from typing import List, Optional
+from urllib.parse import urlsplit
 
 app = FastAPI()
 
@@ -13,12 +24,136 @@ from dotenv import load_dotenv
 # Load environment variables from .env file
 load_dotenv()
 
+from observability import Metrics, instrument, get_logger
+
+logger = get_logger("gateway")
+metrics = Metrics()
+instrument(app, metrics)
+
 # Retrieve URLs from environment variables
 REGISTER_SERVICE_URL = os.environ.get('REGISTER_SERVICE_URL')
 
+# Upstream connection pool settings
+MAX_CONNECTIONS = int(os.environ.get('GATEWAY_MAX_CONNECTIONS', 200))
+MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get('GATEWAY_MAX_KEEPALIVE_CONNECTIONS', 50))
+UPSTREAM_MAX_CONNECTIONS = int(os.environ.get('GATEWAY_UPSTREAM_MAX_CONNECTIONS', 50))
+CONNECT_TIMEOUT = float(os.environ.get('GATEWAY_CONNECT_TIMEOUT', 2.0))
+READ_TIMEOUT = float(os.environ.get('GATEWAY_READ_TIMEOUT', 30.0))
+WRITE_TIMEOUT = float(os.environ.get('GATEWAY_WRITE_TIMEOUT', 30.0))
+POOL_TIMEOUT = float(os.environ.get('GATEWAY_POOL_TIMEOUT', 5.0))
+
+# Session tokens are HS256 JWTs signed by auth_service and verified here without a network hop.
+# Every "kid:secret" pair listed is accepted, so a new key can be rolled out before auth_service
+# starts signing with it.
+def parse_token_keys(value: str):
+    keys = []
+    for entry in value.split(","):
+        kid, _, secret = entry.strip().partition(":")
+        if kid and secret:
+            keys.append((kid, secret.encode()))
+    return keys
+
+
+TOKEN_KEYS = dict(parse_token_keys(os.environ.get('AUTH_TOKEN_KEYS', '')))
+REQUIRE_AUTH = os.environ.get('GATEWAY_REQUIRE_AUTH', '1') == '1'
+if REQUIRE_AUTH and not TOKEN_KEYS:
+    raise RuntimeError("AUTH_TOKEN_KEYS is not set")
+# Allowed clock skew between auth_service and the gateway, in seconds
+TOKEN_LEEWAY = float(os.environ.get('AUTH_TOKEN_LEEWAY', 30.0))
+
+# Shared HTTP client, created on startup and closed on shutdown
+http_client: Optional[httpx.AsyncClient] = None
+# Long-lived streams get their own client so they never hold pooled connections
+stream_client: Optional[httpx.AsyncClient] = None
+# One semaphore per upstream origin caps the connections each backend can take
+upstream_limits = {}
+# origin -> requests this gateway has sent there and not yet seen answered, queued ones included
+upstream_inflight = {}
+
+# Circuit breakers: an origin whose recent calls mostly fail or run slow is cut off for a
+# cooldown, then probed before traffic returns to it
+BREAKER_WINDOW = int(os.environ.get('GATEWAY_BREAKER_WINDOW', 50))
+BREAKER_MIN_REQUESTS = int(os.environ.get('GATEWAY_BREAKER_MIN_REQUESTS', 20))
+BREAKER_ERROR_RATE = float(os.environ.get('GATEWAY_BREAKER_ERROR_RATE', 0.5))
+BREAKER_SLOW_CALL = float(os.environ.get('GATEWAY_BREAKER_SLOW_CALL', 5.0))
+BREAKER_SLOW_RATE = float(os.environ.get('GATEWAY_BREAKER_SLOW_RATE', 0.8))
+BREAKER_COOLDOWN = float(os.environ.get('GATEWAY_BREAKER_COOLDOWN', 10.0))
+BREAKER_PROBES = int(os.environ.get('GATEWAY_BREAKER_PROBES', 1))
+
+# GETs are retried on transport errors and these statuses, while the retry budget allows:
+# every request earns RETRY_BUDGET_RATIO of a retry, banked up to RETRY_BUDGET_MAX
+RETRY_ATTEMPTS = int(os.environ.get('GATEWAY_RETRY_ATTEMPTS', 1))
+RETRY_BUDGET_RATIO = float(os.environ.get('GATEWAY_RETRY_BUDGET_RATIO', 0.1))
+RETRY_BUDGET_MAX = float(os.environ.get('GATEWAY_RETRY_BUDGET_MAX', 10.0))
+RETRY_STATUSES = {502, 503, 504}
+
+# Hedged GETs: when an instance has not answered within its HEDGE_PERCENTILE latency,
+# the same request goes to a second instance and the first good answer wins
+HEDGE_REQUESTS = os.environ.get('GATEWAY_HEDGE_REQUESTS', '0') == '1'
+HEDGE_PERCENTILE = float(os.environ.get('GATEWAY_HEDGE_PERCENTILE', 0.95))
+HEDGE_MIN_DELAY = float(os.environ.get('GATEWAY_HEDGE_MIN_DELAY', 0.01))
+
+# Concurrent identical GETs on polled read routes share one upstream call
+COALESCE_GETS = os.environ.get('GATEWAY_COALESCE_GETS', '1') == '1'
+
+# Rate limits per route class, in requests per second with a burst allowance. Buckets are
+# per authenticated user, or per client IP for anonymous callers. A rate of 0 turns the
+# class off; PUT /rate-limits/{route_class} with the admin token changes a class at runtime.
+RATE_LIMITS = {
+    route_class: {
+        "rate": float(os.environ.get(f'GATEWAY_RATE_LIMIT_{route_class.upper()}_RATE', rate)),
+        "burst": float(os.environ.get(f'GATEWAY_RATE_LIMIT_{route_class.upper()}_BURST', burst)),
+    }
+    for route_class, rate, burst in (("write", 5, 20), ("read", 20, 50), ("upload", 10, 20), ("batch", 1, 5))
+}
+RATE_LIMIT_MAX_KEYS = int(os.environ.get('GATEWAY_RATE_LIMIT_MAX_KEYS', 100000))
+# Operator routes (PUT /rate-limits, DELETE /service-cache) take this in the X-Admin-Token
+# header; unset, they are off
+ADMIN_TOKEN = os.environ.get('GATEWAY_ADMIN_TOKEN')
+# Registrations that name their own address take this in the X-Registry-Secret header, and it
+# is passed on to the register service; unset, only address-less registrations are accepted
+REGISTRY_SECRET = os.environ.get('REGISTRY_SECRET')
+
+# origin -> CircuitBreaker
+circuit_breakers = {}
+# (path, params, headers) -> task of the upstream GET in flight
+inflight_gets = {}
+coalesce_stats = {"calls": 0, "coalesced": 0}
+retry_budget = {"tokens": RETRY_BUDGET_MAX, "spent": 0, "denied": 0}
+
+# Service discovery cache settings
+SERVICE_CACHE_TTL = float(os.environ.get('GATEWAY_SERVICE_CACHE_TTL', 30.0))
+SERVICE_CACHE_NEGATIVE_TTL = float(os.environ.get('GATEWAY_SERVICE_CACHE_NEGATIVE_TTL', 5.0))
+
+# service name -> (expires at, register service payload or None when inactive)
+service_cache = {}
+service_cache_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+# An origin that refused a connection is skipped for this many seconds, then tried again
+CONNECT_QUARANTINE = float(os.environ.get('GATEWAY_CONNECT_QUARANTINE', 5.0))
+# origin -> monotonic time its quarantine ends
+quarantined_origins = {}
+
+# Registry watch: when enabled the gateway follows topology changes pushed by the
+# register service and stops asking it on every request
+REGISTRY_WATCH = os.environ.get('GATEWAY_REGISTRY_WATCH', '1') == '1'
+REGISTRY_WATCH_TIMEOUT = float(os.environ.get('GATEWAY_REGISTRY_WATCH_TIMEOUT', 30.0))
+REGISTRY_WATCH_RETRY = float(os.environ.get('GATEWAY_REGISTRY_WATCH_RETRY', 2.0))
+
+# service name -> instance id -> instance, as last reported by the registry watch
+routing_table = {}
+# service name -> payload shaped like a get_service answer, None when no instance is healthy
+routing_payloads = {}
+# None until the first snapshot arrives, get_service falls back to lookups meanwhile
+routing_revision = None
+registry_watch_task = None
+
 
 class ServiceRegister(BaseModel):
     service_name: str
+    address: Optional[str] = None
+    instance_id: Optional[str] = None
+    load: float = 0.0
+    inflight: int = 0
 
 
 class Message(BaseModel):
@@ -28,6 +163,19 @@ class Message(BaseModel):
     conversation_id: Optional[str] = None
 
 
+class MessageBatch(BaseModel):
+    messages: List[dict]
+
+
+# Checked here because a batch is split across message_service instances, each of which
+# would only see its share; keep it equal to the service's own limit
+MESSAGE_MAX_BATCH_SIZE = int(os.environ.get('MESSAGE_MAX_BATCH_SIZE', 500))
+
+
+class ConversationRead(BaseModel):
+    user_id: str
+
+
 class VideoUpload(BaseModel):
     video: str
     description: str
@@ -40,6 +188,17 @@ class PhotoUpload(BaseModel):
     publish_date: int
 
 
+class VideoUploadSession(BaseModel):
+    description: str
+    publish_date: int
+    size: Optional[int] = None
+
+
+class RateLimit(BaseModel):
+    rate: float
+    burst: float
+
+
 class UserCreate(BaseModel):
     username: str
     password: str
@@ -50,62 +209,833 @@ class UserLogin(BaseModel):
     password: str
 
 
+@app.on_event("startup")
+async def startup_event():
+    global http_client, stream_client, registry_watch_task
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=MAX_CONNECTIONS,
+                            max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS),
+        timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT,
+                              write=WRITE_TIMEOUT, pool=POOL_TIMEOUT),
+    )
+    stream_client = httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=None, max_keepalive_connections=0),
+        timeout=httpx.Timeout(None, connect=CONNECT_TIMEOUT),
+    )
+    if REGISTRY_WATCH:
+        registry_watch_task = asyncio.create_task(watch_registry())
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    global http_client, stream_client, registry_watch_task, routing_revision
+    if registry_watch_task is not None:
+        registry_watch_task.cancel()
+        registry_watch_task = None
+    routing_revision = None
+    if http_client is not None:
+        await http_client.aclose()
+        http_client = None
+    if stream_client is not None:
+        await stream_client.aclose()
+        stream_client = None
+    upstream_limits.clear()
+    circuit_breakers.clear()
+    service_cache.clear()
+    upstream_inflight.clear()
+    quarantined_origins.clear()
+
+
+def url_origin(url: str):
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+def upstream_limit(url: str):
+    # Key the limit on scheme://host:port so every route of a backend shares it
+    origin = url_origin(url)
+    limit = upstream_limits.get(origin)
+    if limit is None:
+        limit = asyncio.Semaphore(UPSTREAM_MAX_CONNECTIONS)
+        upstream_limits[origin] = limit
+    return limit
+
+
+class CircuitBreaker:
+    """Tracks the recent calls to one upstream origin.
+
+    While closed, the outcome of the last BREAKER_WINDOW calls is kept. Once at
+    least BREAKER_MIN_REQUESTS are recorded and the share of failures or of
+    calls slower than BREAKER_SLOW_CALL passes its threshold, the breaker opens
+    and calls are refused without touching the network. After BREAKER_COOLDOWN
+    seconds it goes half-open and lets BREAKER_PROBES calls through: a good one
+    closes it, a bad one opens it again.
+    """
+
+    def __init__(self, origin: str):
+        self.origin = origin
+        self.state = "closed"
+        self.outcomes = deque(maxlen=BREAKER_WINDOW)
+        # Latency of recent successful calls, for the hedging delay
+        self.latencies = deque(maxlen=BREAKER_WINDOW)
+        self.opened_at = 0.0
+        self.probes = 0
+        self.transitions = {"open": 0, "half_open": 0, "closed": 0}
+        self.stats = {"requests": 0, "failures": 0, "rejected": 0, "retries": 0, "hedges": 0, "hedge_wins": 0}
+
+    def transition(self, state: str):
+        self.state = state
+        self.transitions[state] += 1
+        metrics.inc("gateway_breaker_transitions_total", (("upstream", self.origin), ("state", state)))
+        logger.warning("circuit breaker %s", state, extra={"upstream": self.origin})
+        self.probes = 0
+        if state == "open":
+            self.opened_at = time.monotonic()
+        elif state == "closed":
+            self.outcomes.clear()
+
+    def available(self):
+        return self.state != "open" or time.monotonic() - self.opened_at >= BREAKER_COOLDOWN
+
+    def allow(self):
+        if self.state == "open":
+            if not self.available():
+                self.stats["rejected"] += 1
+                return False
+            self.transition("half_open")
+        if self.state == "half_open":
+            if self.probes >= BREAKER_PROBES:
+                self.stats["rejected"] += 1
+                return False
+            self.probes += 1
+        return True
+
+    def release(self):
+        # A probe that ended without an outcome, cancelled or failed in our own code, frees its slot
+        if self.state == "half_open" and self.probes:
+            self.probes -= 1
+
+    def record(self, failed: bool, latency: float):
+        self.stats["requests"] += 1
+        if failed:
+            self.stats["failures"] += 1
+        else:
+            self.latencies.append(latency)
+        slow = latency >= BREAKER_SLOW_CALL
+        if self.state == "half_open":
+            self.transition("open" if failed or slow else "closed")
+            return
+        if self.state == "open":
+            return
+        self.outcomes.append((failed, slow))
+        if len(self.outcomes) >= BREAKER_MIN_REQUESTS:
+            failures = sum(failed for failed, _ in self.outcomes)
+            slow_calls = sum(slow for _, slow in self.outcomes)
+            if (failures >= BREAKER_ERROR_RATE * len(self.outcomes)
+                    or slow_calls >= BREAKER_SLOW_RATE * len(self.outcomes)):
+                self.transition("open")
+
+    def latency_percentile(self, percentile: float):
+        if len(self.latencies) < BREAKER_MIN_REQUESTS:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(int(percentile * len(latencies)), len(latencies) - 1)]
+
+    def info(self):
+        return {
+            "state": self.state,
+            "transitions": self.transitions,
+            **self.stats,
+            "p50": self.latency_percentile(0.5),
+            "hedge_after": hedge_delay(self),
+        }
+
+
+def circuit_breaker(url: str):
+    origin = url_origin(url)
+    breaker = circuit_breakers.get(origin)
+    if breaker is None:
+        breaker = CircuitBreaker(origin)
+        circuit_breakers[origin] = breaker
+    return breaker
+
+
+def hedge_delay(breaker: CircuitBreaker):
+    latency = breaker.latency_percentile(HEDGE_PERCENTILE)
+    return None if latency is None else max(latency, HEDGE_MIN_DELAY)
+
+
+def withdraw_retry():
+    if retry_budget["tokens"] < 1:
+        retry_budget["denied"] += 1
+        return False
+    retry_budget["tokens"] -= 1
+    retry_budget["spent"] += 1
+    return True
+
+
+# The same URL on another known instance of the backend whose breaker lets calls through
+def alternate_url(url: str):
+    payloads = [*routing_payloads.values(), *(cached[1] for cached in service_cache.values())]
+    for payload in payloads:
+        if not payload:
+            continue
+        addresses = service_instances(payload)
+        current = next((address for address in addresses if url.startswith(address)), None)
+        if current is None:
+            continue
+        candidates = [address for address in addresses
+                      if address != current and circuit_breaker(address).available()]
+        if candidates:
+            return random.choice(candidates) + url[len(current):]
+        return None
+    return None
+
+
+async def upstream_attempt(method: str, url: str, **kwargs):
+    breaker = circuit_breaker(url)
+    labels = (("upstream", breaker.origin), ("method", method))
+    if not breaker.allow():
+        metrics.inc("gateway_upstream_requests_total", (*labels, ("status", "rejected")))
+        raise HTTPException(status_code=503, detail="Upstream unavailable", headers={"Retry-After": "1"})
+    status = "cancelled"
+    upstream_inflight[breaker.origin] = upstream_inflight.get(breaker.origin, 0) + 1
+    try:
+        async with upstream_limit(url):
+            started = time.monotonic()
+            metrics.add("gateway_upstream_in_flight", labels[:1])
+            try:
+                response = await http_client.request(method, url, **kwargs)
+                status = str(response.status_code)
+            except httpx.TransportError as e:
+                status = type(e).__name__
+                breaker.record(True, time.monotonic() - started)
+                if isinstance(e, httpx.ConnectError):
+                    # The backend is gone, make the next request look it up again
+                    invalidate_service_address(url)
+                raise
+            finally:
+                metrics.add("gateway_upstream_in_flight", labels[:1], -1)
+                metrics.observe("gateway_upstream_request_duration_seconds", labels, time.monotonic() - started)
+    except BaseException:
+        # Cancelled, or failed on our side such as a client disconnecting mid-upload: no outcome
+        # for the upstream. After a recorded transport error the probe has already moved on.
+        breaker.release()
+        raise
+    finally:
+        upstream_inflight[breaker.origin] -= 1
+        metrics.inc("gateway_upstream_requests_total", (*labels, ("status", status)))
+    breaker.record(response.status_code >= 500, time.monotonic() - started)
+    return response
+
+
+async def hedged_get(url: str, **kwargs):
+    primary = asyncio.ensure_future(upstream_attempt("GET", url, **kwargs))
+    pending = {primary}
+    try:
+        breaker = circuit_breaker(url)
+        delay = hedge_delay(breaker)
+        alternate = alternate_url(url) if delay is not None else None
+        if alternate is None:
+            return await primary
+        done, _ = await asyncio.wait(pending, timeout=delay)
+        if done or not withdraw_retry():
+            return await primary
+        breaker.stats["hedges"] += 1
+        hedge = asyncio.ensure_future(upstream_attempt("GET", alternate, **kwargs))
+        pending.add(hedge)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None and task.result().status_code < 500:
+                    if task is hedge:
+                        breaker.stats["hedge_wins"] += 1
+                    return task.result()
+        # Both failed, answer like the primary did
+        hedge.exception()
+        return primary.result()
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def upstream_request(method: str, url: str, **kwargs):
+    retry_budget["tokens"] = min(retry_budget["tokens"] + RETRY_BUDGET_RATIO, RETRY_BUDGET_MAX)
+    if not circuit_breaker(url).available():
+        url = alternate_url(url) or url
+    if method != "GET":
+        return await upstream_attempt(method, url, **kwargs)
+
+    # Only idempotent reads are retried or hedged
+    attempts = 0
+    while True:
+        failure = None
+        try:
+            if HEDGE_REQUESTS:
+                response = await hedged_get(url, **kwargs)
+            else:
+                response = await upstream_attempt("GET", url, **kwargs)
+            if response.status_code not in RETRY_STATUSES:
+                return response
+        except httpx.TransportError as e:
+            failure = e
+        except HTTPException as e:
+            # Refused by an open breaker: only worth retrying on another instance
+            if e.status_code != 503 or alternate_url(url) is None:
+                raise
+            failure = e
+        if attempts >= RETRY_ATTEMPTS or not withdraw_retry():
+            if failure is not None:
+                raise failure
+            return response
+        attempts += 1
+        circuit_breaker(url).stats["retries"] += 1
+        url = alternate_url(url) or url
+
+
+def invalidate_service(service_name: str):
+    if service_cache.pop(service_name, None) is not None:
+        service_cache_stats["invalidations"] += 1
+
+
+def invalidate_service_address(url: str):
+    origin = url_origin(url)
+    for service_name, (_, payload) in list(service_cache.items()):
+        if payload and origin in [url_origin(address) for address in service_instances(payload)]:
+            invalidate_service(service_name)
+    # Skip it for a while rather than dropping it from the routing table: static instances
+    # never send the registry event that would put it back
+    quarantined_origins[origin] = time.monotonic() + CONNECT_QUARANTINE
+
+
+def reachable_payload(payload):
+    # The payload without quarantined instances, or unchanged when that would leave none
+    if not payload or not quarantined_origins:
+        return payload
+    now = time.monotonic()
+    for origin, until in list(quarantined_origins.items()):
+        if until <= now:
+            del quarantined_origins[origin]
+    instances = [address for address in service_instances(payload)
+                 if url_origin(address) not in quarantined_origins]
+    if not instances or len(instances) == len(service_instances(payload)):
+        return payload
+    return {**payload, "address": instances[0], "instances": instances}
+
+
+def service_instances(payload):
+    return payload.get("instances") or [payload["address"]]
+
+
+def pick_instance(service_name: str, payload):
+    # Power of two choices: of two random instances, take the one with fewer requests in flight
+    # from this gateway, then the one that last reported fewer to the registry
+    instances = service_instances(payload)
+    if len(instances) == 1:
+        return payload
+    reported = {instance["address"]: instance["inflight"]
+                for instance in routing_table.get(service_name, {}).values()}
+    address = min(random.sample(instances, 2),
+                  key=lambda address: (upstream_inflight.get(url_origin(address), 0), reported.get(address, 0)))
+    return {**payload, "address": address}
+
+
+# Subscriptions live in one message_service process, so a user's stream and the messages
+# sent to that user must reach the same instance. Rendezvous hashing picks it: a user
+# only moves when their instance goes away, and their client then reconnects.
+def subscriber_address(payload, user_id: str):
+    return max(service_instances(payload),
+               key=lambda address: hashlib.sha1(f"{address}|{user_id}".encode()).digest())
+
+
+def routing_payload(instances):
+    if not instances:
+        return None
+    return {"address": instances[0], "instances": instances, "is_active": True}
+
+
+def rebuild_routing_payload(service_name: str):
+    instances = routing_table.get(service_name, {}).values()
+    routing_payloads[service_name] = routing_payload(
+        [instance["address"] for instance in instances if instance["healthy"]])
+
+
+def apply_registry_update(update):
+    global routing_revision
+    if update["reset"]:
+        routing_table.clear()
+        routing_payloads.clear()
+        for service_name, instances in update["services"].items():
+            routing_table[service_name] = {instance["instance_id"]: instance for instance in instances}
+            rebuild_routing_payload(service_name)
+    else:
+        for event in update["events"]:
+            instances = routing_table.setdefault(event["service_name"], {})
+            instance = event["instance"]
+            if event["type"] == "remove":
+                instances.pop(instance["instance_id"], None)
+            else:
+                instances[instance["instance_id"]] = instance
+            rebuild_routing_payload(event["service_name"])
+    routing_revision = update["revision"]
+
+
+async def watch_registry():
+    global routing_revision
+    while True:
+        try:
+            params = {"timeout": REGISTRY_WATCH_TIMEOUT}
+            if routing_revision is not None:
+                params["revision"] = routing_revision
+            response = await http_client.get(f"{REGISTER_SERVICE_URL}/watch", params=params,
+                                             timeout=REGISTRY_WATCH_TIMEOUT + READ_TIMEOUT)
+            response.raise_for_status()
+            apply_registry_update(response.json())
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Fall back to per-request lookups until the watch is back
+            logger.warning("registry watch failed: %s", e)
+            routing_revision = None
+            await asyncio.sleep(REGISTRY_WATCH_RETRY)
+
+
+def b64url_decode(data: str):
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+# All tokens signed with one key share a header, so the parsed header and key lookup are cached
+@lru_cache(maxsize=64)
+def token_key(header_part: str):
+    header = json.loads(b64url_decode(header_part))
+    if header.get("alg") != "HS256":
+        return None
+    return TOKEN_KEYS.get(header.get("kid"))
+
+
+# Claims of a valid, unexpired token, otherwise None
+def verify_token(token: str):
+    try:
+        header_part, claims_part, signature_part = token.split(".")
+        key = token_key(header_part)
+        if key is None:
+            return None
+        expected = hmac.new(key, f"{header_part}.{claims_part}".encode(), hashlib.sha256).digest()
+        if not hmac.compare_digest(expected, b64url_decode(signature_part)):
+            return None
+        claims = json.loads(b64url_decode(claims_part))
+        if claims["exp"] + TOKEN_LEEWAY < time.time():
+            return None
+        return claims
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return None
+
+
+# The subject of the request's token, or None. EventSource cannot set headers, so the
+# SSE stream alone may take the token as the access_token query parameter; anywhere
+# else it would end up in URLs and access logs.
+async def token_subject(request: Request):
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer":
+        token = request.query_params.get("access_token") if request.scope.get("endpoint") is subscribe else None
+    claims = verify_token(token) if token else None
+    return claims and claims["sub"]
+
+
+# Dependency resolving the caller from the bearer token
+async def authenticated_user(subject: Optional[str] = Depends(token_subject)):
+    if not REQUIRE_AUTH:
+        return None
+    if subject is None:
+        raise HTTPException(status_code=401, detail="Invalid or expired token",
+                            headers={"WWW-Authenticate": "Bearer"})
+    return subject
+
+
+class RateLimiter:
+    """Token buckets per route class and client.
+
+    A bucket is [tokens, last refill] and refills lazily when used. Buckets
+    are kept in last-use order; one idle long enough to have refilled is the
+    same as a new one, so a few of those are dropped from the old end on
+    every call, and never more than `max_keys` are kept.
+    """
+
+    def __init__(self, limits, max_keys: int):
+        self.limits = limits
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()
+        self.stats = {"allowed": 0, "limited": 0, "evicted": 0}
+
+    def take(self, route_class: str, client: str):
+        # Seconds until a token is available, 0 when the request may go ahead
+        limit = self.limits.get(route_class)
+        if not limit or limit["rate"] <= 0:
+            return 0.0
+        now = time.monotonic()
+        self.evict(now)
+        key = (route_class, client)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = [limit["burst"], now]
+            self.buckets[key] = bucket
+        else:
+            bucket[0] = min(limit["burst"], bucket[0] + (now - bucket[1]) * limit["rate"])
+            bucket[1] = now
+            self.buckets.move_to_end(key)
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            self.stats["allowed"] += 1
+            return 0.0
+        self.stats["limited"] += 1
+        return (1 - bucket[0]) / limit["rate"]
+
+    def evict(self, now: float):
+        for _ in range(2):
+            if not self.buckets:
+                return
+            (route_class, _), bucket = next(iter(self.buckets.items()))
+            limit = self.limits.get(route_class)
+            refilled = (not limit or limit["rate"] <= 0
+                        or bucket[0] + (now - bucket[1]) * limit["rate"] >= limit["burst"])
+            if not refilled and len(self.buckets) < self.max_keys:
+                return
+            self.buckets.popitem(last=False)
+            self.stats["evicted"] += 1
+
+    def configure(self, route_class: str, rate: float, burst: float):
+        self.limits[route_class] = {"rate": rate, "burst": burst}
+        # Buckets refill against the new limit the next time they are used
+        for (bucket_class, _), bucket in self.buckets.items():
+            if bucket_class == route_class:
+                bucket[0] = min(bucket[0], burst)
+
+
+rate_limiter = RateLimiter(RATE_LIMITS, RATE_LIMIT_MAX_KEYS)
+
+
+def rate_limit(route_class: str):
+    async def check(request: Request, subject: Optional[str] = Depends(token_subject)):
+        client = f"user:{subject}" if subject else f"ip:{request.client.host if request.client else 'unknown'}"
+        retry_after = rate_limiter.take(route_class, client)
+        if retry_after:
+            metrics.inc("gateway_rate_limited_total", (("class", route_class),))
+            raise HTTPException(status_code=429, detail="Too many requests",
+                                headers={"Retry-After": str(math.ceil(retry_after))})
+    return Depends(check)
+
+
+limit_writes = rate_limit("write")
+limit_reads = rate_limit("read")
+limit_uploads = rate_limit("upload")
+limit_batches = rate_limit("batch")
+
+
+async def admin_only(x_admin_token: Optional[str] = Header(None)):
+    if not ADMIN_TOKEN or not x_admin_token or not hmac.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+
+def require_user(caller: Optional[str], user_id: str):
+    if caller is not None and caller != user_id:
+        raise HTTPException(status_code=403, detail="Token does not belong to this user")
+
+
+def finish_coalesced(key, task):
+    inflight_gets.pop(key, None)
+    if not task.cancelled():
+        # Nobody may be left to look at the failure
+        task.exception()
+
+
+# GET through upstream_request, joining an identical call already in flight. Upstream
+# calls carry no caller credentials, so every waiter may share the answer.
+async def coalesced_get(url: str, params=None, headers=None):
+    coalesce_stats["calls"] += 1
+    if not COALESCE_GETS:
+        return await upstream_request("GET", url, params=params, headers=headers)
+    # Keyed without the origin, so requests routed to different instances still meet
+    key = (urlsplit(url).path, tuple(sorted((params or {}).items())), tuple(sorted((headers or {}).items())))
+    task = inflight_gets.get(key)
+    if task is None:
+        task = asyncio.ensure_future(upstream_request("GET", url, params=params, headers=headers))
+        inflight_gets[key] = task
+        task.add_done_callback(lambda done: finish_coalesced(key, done))
+    else:
+        coalesce_stats["coalesced"] += 1
+    # One waiter giving up must not cancel the call for the others
+    return await asyncio.shield(task)
+
+
+def conditional_headers(request: Request):
+    if_none_match = request.headers.get("if-none-match")
+    return {"If-None-Match": if_none_match} if if_none_match else {}
+
+
+# Pass a JSON answer through without decoding it, keeping its ETag
+def relay_json(response: httpx.Response):
+    headers = {"ETag": response.headers["etag"]} if "etag" in response.headers else {}
+    if response.status_code == 304:
+        return Response(status_code=304, headers=headers)
+    return Response(content=response.content, media_type="application/json", headers=headers)
+
+
+# auth_service sheds load with 503 while its password pool is full; keep the client's hint
+def overloaded(response: httpx.Response):
+    headers = {"Retry-After": response.headers["retry-after"]} if "retry-after" in response.headers else {}
+    return HTTPException(status_code=503, detail="Service overloaded, try again later", headers=headers)
+
+
+def stream_headers(request: Request):
+    # Forward the body as-is; without a length httpx sends it chunked
+    headers = {'Content-Type': request.headers.get('content-type', 'application/octet-stream')}
+    if 'content-length' in request.headers:
+        headers['Content-Length'] = request.headers['content-length']
+    return headers
+
+
+# Media is relayed chunk by chunk with its validators, whole files never sit in the gateway
+MEDIA_REQUEST_HEADERS = ("range", "if-range", "if-none-match", "if-modified-since")
+MEDIA_RESPONSE_HEADERS = ("content-type", "content-length", "content-range", "accept-ranges",
+                          "etag", "last-modified", "cache-control")
+
+
+async def media_proxy(service_name: str, path: str, request: Request, not_found: str):
+    response_payload = await get_service(service_name)
+    if not response_payload:
+        raise HTTPException(status_code=404, detail="Service not found")
+    url = f'{response_payload["address"].rstrip("/")}{path}'
+    breaker = circuit_breaker(url)
+    labels = (("upstream", breaker.origin), ("method", request.method))
+    if not breaker.allow():
+        metrics.inc("gateway_upstream_requests_total", (*labels, ("status", "rejected")))
+        raise HTTPException(status_code=503, detail="Upstream unavailable", headers={"Retry-After": "1"})
+    headers = {name: request.headers[name] for name in MEDIA_REQUEST_HEADERS if name in request.headers}
+
+    # A body can take minutes to relay, so it goes over stream_client instead of the pool,
+    # but it holds one of the origin's upstream_limit slots until the last byte is out
+    limit = upstream_limit(url)
+    upstream_inflight[breaker.origin] = upstream_inflight.get(breaker.origin, 0) + 1
+    acquired = False
+
+    def release():
+        nonlocal acquired
+        if acquired:
+            acquired = False
+            limit.release()
+            metrics.add("gateway_upstream_in_flight", labels[:1], -1)
+            upstream_inflight[breaker.origin] -= 1
+
+    status = "cancelled"
+    try:
+        await limit.acquire()
+        acquired = True
+        started = time.monotonic()
+        metrics.add("gateway_upstream_in_flight", labels[:1])
+        try:
+            upstream = stream_client.build_request(request.method, url, headers=headers)
+            response = await stream_client.send(upstream, stream=True)
+            status = str(response.status_code)
+        except httpx.TransportError as e:
+            status = type(e).__name__
+            breaker.record(True, time.monotonic() - started)
+            if isinstance(e, httpx.ConnectError):
+                invalidate_service_address(url)
+            raise HTTPException(status_code=500, detail=str(e))
+        finally:
+            # Measured to the response headers, the body streams on after this
+            metrics.observe("gateway_upstream_request_duration_seconds", labels, time.monotonic() - started)
+    except BaseException:
+        if not acquired:
+            upstream_inflight[breaker.origin] -= 1
+        release()
+        breaker.release()
+        raise
+    finally:
+        metrics.inc("gateway_upstream_requests_total", (*labels, ("status", status)))
+    breaker.record(response.status_code >= 500, time.monotonic() - started)
+
+    if response.status_code not in (200, 206, 304, 416):
+        await response.aclose()
+        release()
+        if response.status_code == 404:
+            raise HTTPException(status_code=404, detail=not_found)
+        raise HTTPException(status_code=500, detail="Failed to fetch media")
+
+    async def relay():
+        try:
+            async for chunk in response.aiter_raw():
+                yield chunk
+        finally:
+            await response.aclose()
+            release()
+
+    headers = {name: response.headers[name] for name in MEDIA_RESPONSE_HEADERS if name in response.headers}
+    return StreamingResponse(relay(), status_code=response.status_code, headers=headers)
+
+
+async def get_service(service_name: str):
+    started = time.perf_counter()
+    try:
+        response_payload = await lookup_service(service_name)
+    finally:
+        metrics.observe("gateway_registry_lookup_seconds", (("service", service_name),),
+                        time.perf_counter() - started)
+    logger.debug("resolved %s to %s", service_name, response_payload and response_payload["address"])
+    return response_payload
+
+
+async def lookup_service(service_name: str):
+    # Ask the register service where a backend lives; None if it is not active
+    if routing_revision is not None:
+        service_cache_stats["hits"] += 1
+        payload = reachable_payload(routing_payloads.get(service_name))
+        return payload and pick_instance(service_name, payload)
+
+    cached = service_cache.get(service_name)
+    if cached and cached[0] > time.monotonic():
+        service_cache_stats["hits"] += 1
+        payload = reachable_payload(cached[1])
+        return payload and pick_instance(service_name, payload)
+
+    service_cache_stats["misses"] += 1
+    response = await upstream_request("GET", f"{REGISTER_SERVICE_URL}/get_service/{service_name}")
+    response_payload = response.json()
+    if not response_payload or not response_payload.get("is_active"):
+        service_cache[service_name] = (time.monotonic() + SERVICE_CACHE_NEGATIVE_TTL, None)
+        return None
+    service_cache[service_name] = (time.monotonic() + SERVICE_CACHE_TTL, response_payload)
+    return pick_instance(service_name, reachable_payload(response_payload))
+
+
 @app.post("/health")
 async def urmom():
     return "sss"
 
 
-@app.post("/register-user/")
+# Circuit breaker state, retries and hedges per upstream origin, plus the retry budget
+@app.get("/upstream-stats")
+async def upstream_stats():
+    return {
+        "upstreams": {origin: breaker.info() for origin, breaker in circuit_breakers.items()},
+        "retry_budget": retry_budget,
+        "coalescing": {**coalesce_stats, "in_flight": len(inflight_gets)},
+    }
+
+
+@app.get("/rate-limits")
+async def rate_limits_info():
+    return {"limits": rate_limiter.limits, "clients": len(rate_limiter.buckets), **rate_limiter.stats}
+
+
+# Change a route class's limit without a restart
+@app.put("/rate-limits/{route_class}", dependencies=[limit_writes, Depends(admin_only)])
+async def rate_limits_configure(route_class: str, data: RateLimit):
+    if route_class not in rate_limiter.limits:
+        raise HTTPException(status_code=404, detail="Unknown route class")
+    if data.rate < 0 or data.burst < 1:
+        raise HTTPException(status_code=400, detail="rate must be >= 0 and burst >= 1")
+    rate_limiter.configure(route_class, data.rate, data.burst)
+    return rate_limiter.limits[route_class]
+
+
+@app.get("/service-cache")
+async def service_cache_info():
+    return {
+        **service_cache_stats,
+        "entries": len(service_cache),
+        "ttl": SERVICE_CACHE_TTL,
+        "negative_ttl": SERVICE_CACHE_NEGATIVE_TTL,
+        "watch_revision": routing_revision,
+    }
+
+
+@app.delete("/service-cache/{service_name}", dependencies=[Depends(admin_only)])
+async def service_cache_invalidate(service_name: str):
+    invalidate_service(service_name)
+    return {"message": "Service cache entry invalidated"}
+
+
+@app.post("/register-user/", dependencies=[limit_writes])
 async def register_user(user: UserCreate):
-    response = requests.get(f"{REGISTER_SERVICE_URL}/get_service/auth_service")
-    response_payload = response.json()
-    print(response_payload)
-    if response_payload["is_active"]:
-        # print("service is registered")
+    response_payload = await get_service("auth_service")
+    if response_payload:
         try:
             payload = {
                 'username': user.username,
                 'password': user.password,
             }
 
-            response = requests.post(f'{response_payload["address"]}/register-user/', json=payload)
+            response = await upstream_request("POST", f'{response_payload["address"]}/register-user/', json=payload)
 
             if response.status_code == 200:
                 return {"message": "User registered successfully"}
             elif response.status_code == 400:
                 return {"message": "User already registered"}
+            elif response.status_code == 503:
+                raise overloaded(response)
             else:
                 raise HTTPException(status_code=500, detail="Failed to register user")
 
+        except HTTPException:
+            raise
         except Exception as e:
             raise HTTPException(status_code=500, detail=str(e))
     else:
         raise HTTPException(status_code=404, detail="Service not found")
 
 
-@app.post("/login/")
+@app.post("/login/", dependencies=[limit_writes])
 async def login_user(user: UserLogin):
-    response = requests.get(f"{REGISTER_SERVICE_URL}/get_service/auth_service")
-    response_payload = response.json()
-    print(response_payload)
-    if response_payload["is_active"]:
-        # print("service is registered")
+    response_payload = await get_service("auth_service")
+    if response_payload:
         try:
             payload = {
                 'username': user.username,
                 'password': user.password,
             }
 
-            response = requests.post(f'{response_payload["address"]}/login/', json=payload)
+            response = await upstream_request("POST", f'{response_payload["address"]}/login/', json=payload)
 
             if response.status_code == 200:
                 response_data = response.json()
                 user_id = response_data.get('user_id')
                 return {"message": "Login successful",
-                        "user_id": user_id}
+                        "user_id": user_id,
+                        "token": response_data.get('token'),
+                        "expires_at": response_data.get('expires_at')}
+            elif response.status_code == 401:
+                raise HTTPException(status_code=401, detail="Invalid credentials")
+            elif response.status_code == 503:
+                raise overloaded(response)
             else:
                 raise HTTPException(status_code=500, detail="Login Failed")
 
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+    else:
+        raise HTTPException(status_code=404, detail="Service not found")
+
+
+# Public profiles for many users at once, e.g. the participants of an inbox page
+@app.get("/users", dependencies=[limit_reads, Depends(authenticated_user)])
+async def get_users(ids: List[str] = Query(...)):
+    response_payload = await get_service("auth_service")
+    if response_payload:
+        try:
+            response = await upstream_request("GET", f'{response_payload["address"]}/users', params={'ids': ids})
+
+            if response.status_code == 200:
+                return response.json()
+            elif response.status_code == 400:
+                raise HTTPException(status_code=400, detail=response.json().get("detail"))
+            else:
+                raise HTTPException(status_code=500, detail="Failed to get users")
+
+        except HTTPException:
+            raise
         except Exception as e:
             raise HTTPException(status_code=500, detail=str(e))
     else:
@@ -113,32 +1043,41 @@ async def login_user(user: UserLogin):
 
 
 @app.post("/register")
-async def register_service(data: ServiceRegister):
-    print(data.service_name)
+async def register_service(data: ServiceRegister, x_registry_secret: Optional[str] = Header(None)):
+    logger.debug("registering %s", data.service_name, extra={"address": data.address})
+    # Anyone can reach this route, so only holders of the secret may point the registry somewhere
+    if data.address and (not REGISTRY_SECRET or not x_registry_secret
+                         or not hmac.compare_digest(x_registry_secret, REGISTRY_SECRET)):
+        raise HTTPException(status_code=403, detail="Registry secret required")
     payload = {
-        'service_name': data.service_name
+        'address': data.address,
+        'instance_id': data.instance_id,
+        'load': data.load,
+        'inflight': data.inflight,
     }
 
     # headers = {'Content-Type': 'application/json'}
-    response = requests.post(f"{REGISTER_SERVICE_URL}/register_service/{data.service_name}")
+    response = await upstream_request("POST", f"{REGISTER_SERVICE_URL}/register_service/{data.service_name}",
+                                      json=payload, headers={"X-Registry-Secret": REGISTRY_SECRET or ""})
     if response.status_code == 200:
-        return {"message": "Service registered successfully"}
+        response_payload = response.json() or {}
+        if response_payload.get("new_instance"):
+            # Drop the cache entry so the new instance is picked up right away
+            invalidate_service(data.service_name)
+        return {"message": "Service registered successfully",
+                "instance_id": response_payload.get("instance_id"),
+                "heartbeat_ttl": response_payload.get("heartbeat_ttl")}
     else:
         raise HTTPException(status_code=500, detail="Failed to upload video")
 
     # return "urmom"
 
 
-@app.post("/upload-video")
+@app.post("/upload-video", dependencies=[limit_uploads, Depends(authenticated_user)])
 async def upload_video(data: VideoUpload):
-    response = requests.get(f"{REGISTER_SERVICE_URL}/get_service/video_service")
-    response_payload = response.json()
-    print(response_payload)
-    if response_payload["is_active"]:
-        # print("service is registered")
+    response_payload = await get_service("video_service")
+    if response_payload:
         try:
-            video_bytes = base64.b64decode(data.video.encode('utf-8'))
-
             payload = {
                 'video': data.video,
                 'description': data.description,
@@ -146,26 +1085,132 @@ async def upload_video(data: VideoUpload):
                 'uid': "data.uid"
             }
 
-            response = requests.post(response_payload["address"], json=payload)
+            response = await upstream_request("POST", response_payload["address"], json=payload)
 
             if response.status_code == 200:
-                return {"message": "Video uploaded successfully"}
+                return response.json()
             else:
                 raise HTTPException(status_code=500, detail="Failed to upload video")
 
+        except HTTPException:
+            raise
         except Exception as e:
             raise HTTPException(status_code=500, detail=str(e))
     else:
         raise HTTPException(status_code=404, detail="Service not found")
 
 
-@app.post("/send-message/")
-async def send_message(data: Message):
-    response = requests.get(f"{REGISTER_SERVICE_URL}/get_service/message_service")
-    response_payload = response.json()
-    print(response_payload)
-    if response_payload["is_active"]:
-        # print("service is registered")
+# Raw body upload for large videos, piped to the video service chunk by chunk
+@app.post("/upload-video/stream", dependencies=[limit_uploads, Depends(authenticated_user)])
+async def upload_video_stream(request: Request, description: str, publish_date: int):
+    response_payload = await get_service("video_service")
+    if response_payload:
+        try:
+            response = await upstream_request(
+                "POST", f'{response_payload["address"].rstrip("/")}/stream',
+                params={'description': description, 'publish_date': publish_date},
+                content=request.stream(),
+                headers=stream_headers(request))
+
+            if response.status_code == 200:
+                return response.json()
+            else:
+                raise HTTPException(status_code=500, detail="Failed to upload video")
+
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+    else:
+        raise HTTPException(status_code=404, detail="Service not found")
+
+
+@app.api_route("/video/{publish_date}", methods=["GET", "HEAD"],
+               dependencies=[limit_reads, Depends(authenticated_user)])
+async def get_video(publish_date: int, request: Request):
+    return await media_proxy("video_service", f"/{publish_date}", request, "Video not found")
+
+
+# Post-processing job status from a media service
+async def media_job(service_name: str, job_id: str):
+    response_payload = await get_service(service_name)
+    if not response_payload:
+        raise HTTPException(status_code=404, detail="Service not found")
+    try:
+        response = await upstream_request(
+            "GET", f'{response_payload["address"].rstrip("/")}/jobs/{job_id}')
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    if response.status_code == 200:
+        return response.json()
+    elif response.status_code == 404:
+        raise HTTPException(status_code=404, detail="Job not found")
+    else:
+        raise HTTPException(status_code=500, detail="Failed to fetch job")
+
+
+@app.get("/video/jobs/{job_id}", dependencies=[limit_reads, Depends(authenticated_user)])
+async def get_video_job(job_id: str):
+    return await media_job("video_service", job_id)
+
+
+@app.get("/photo/jobs/{job_id}", dependencies=[limit_reads, Depends(authenticated_user)])
+async def get_photo_job(job_id: str):
+    return await media_job("photo_service", job_id)
+
+
+# Resumable video uploads: create a session, PUT chunks (in any order), check the
+# offset to resume after a failure, then complete to move the file into place
+async def video_upload_request(method: str, path: str, **kwargs):
+    response_payload = await get_service("video_service")
+    if not response_payload:
+        raise HTTPException(status_code=404, detail="Service not found")
+    try:
+        response = await upstream_request(
+            method, f'{response_payload["address"].rstrip("/")}/uploads{path}', **kwargs)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    if response.status_code == 200:
+        return response.json()
+    elif response.status_code in (400, 404, 409):
+        raise HTTPException(status_code=response.status_code, detail=response.json().get("detail"))
+    else:
+        raise HTTPException(status_code=500, detail="Failed to upload video")
+
+
+@app.post("/upload-video/sessions", dependencies=[limit_uploads, Depends(authenticated_user)])
+async def create_video_upload(data: VideoUploadSession):
+    return await video_upload_request("POST", "", json=data.dict())
+
+
+@app.get("/upload-video/sessions/{upload_id}", dependencies=[limit_uploads, Depends(authenticated_user)])
+async def get_video_upload(upload_id: str):
+    return await video_upload_request("GET", f"/{upload_id}")
+
+
+@app.put("/upload-video/sessions/{upload_id}/chunks/{index}",
+         dependencies=[limit_uploads, Depends(authenticated_user)])
+async def upload_video_chunk(upload_id: str, index: int, offset: int, request: Request):
+    return await video_upload_request("PUT", f"/{upload_id}/chunks/{index}", params={'offset': offset},
+                                      content=request.stream(), headers=stream_headers(request))
+
+
+@app.post("/upload-video/sessions/{upload_id}/complete", dependencies=[limit_uploads, Depends(authenticated_user)])
+async def complete_video_upload(upload_id: str):
+    return await video_upload_request("POST", f"/{upload_id}/complete")
+
+
+@app.post("/send-message/", dependencies=[limit_writes])
+async def send_message(data: Message, caller: Optional[str] = Depends(authenticated_user)):
+    require_user(caller, data.user_id)
+    response_payload = await get_service("message_service")
+    if response_payload:
         try:
             payload = {
                 'user_id': data.user_id,
@@ -174,73 +1219,217 @@ async def send_message(data: Message):
                 'conversation_id': data.conversation_id
             }
 
-            response = requests.post(f'{response_payload["address"]}/send-message/', json=payload)
+            # Delivered live to the recipient's subscribers; the sender has the response
+            address = subscriber_address(response_payload, data.participant_id)
+            response = await upstream_request("POST", f'{address}/send-message/', json=payload)
 
             if response.status_code == 200:
                 return {"message": "Message sent successfully"}
             else:
                 raise HTTPException(status_code=500, detail="Failed to send message")
 
+        except HTTPException:
+            raise
         except Exception as e:
             raise HTTPException(status_code=500, detail=str(e))
     else:
         raise HTTPException(status_code=404, detail="Service not found")
 
 
-@app.get("/conversations/{user_id}")
-async def get_message(user_id: str):
-    response = requests.get(f"{REGISTER_SERVICE_URL}/get_service/message_service")
-    response_payload = response.json()
-    print(response_payload)
-    if response_payload["is_active"]:
-        # print("service is registered")
+# Many messages in one call; each item gets its own status in the results
+@app.post("/send-messages/", dependencies=[limit_batches])
+async def send_messages(data: MessageBatch, caller: Optional[str] = Depends(authenticated_user)):
+    if len(data.messages) > MESSAGE_MAX_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail=f"At most {MESSAGE_MAX_BATCH_SIZE} messages per batch")
+    results = {}
+    forwarded = []
+    for index, message in enumerate(data.messages):
+        if caller is not None and isinstance(message, dict) and message.get("user_id") != caller:
+            results[index] = {"index": index, "status": 403, "error": "Token does not belong to this user"}
+        else:
+            forwarded.append(index)
+
+    if forwarded:
+        response_payload = await get_service("message_service")
+        if not response_payload:
+            raise HTTPException(status_code=404, detail="Service not found")
+        # Each message goes to the instance its recipient subscribes on
+        groups = {}
+        for index in forwarded:
+            message = data.messages[index]
+            recipient = message.get("participant_id") if isinstance(message, dict) else None
+            groups.setdefault(subscriber_address(response_payload, str(recipient)), []).append(index)
+        # Other groups may already be committed when one fails, so failures are reported
+        # per message and the client resends only those
+        responses = await asyncio.gather(*(
+            upstream_request("POST", f'{address}/send-messages/',
+                             json={'messages': [data.messages[index] for index in indexes]})
+            for address, indexes in groups.items()), return_exceptions=True)
+
+        for indexes, response in zip(groups.values(), responses):
+            if isinstance(response, HTTPException):
+                status, error = response.status_code, response.detail
+            elif isinstance(response, BaseException):
+                status, error = 500, str(response)
+            elif response.status_code == 200:
+                for result in response.json()["results"]:
+                    index = indexes[result["index"]]
+                    results[index] = {**result, "index": index}
+                continue
+            elif response.status_code == 400:
+                status, error = 400, response.json().get("detail")
+            else:
+                status, error = 500, "Failed to send messages"
+            for index in indexes:
+                results[index] = {"index": index, "status": status, "error": error}
+
+    results = [results[index] for index in range(len(data.messages))]
+    sent = sum(result["status"] == 200 for result in results)
+    return {"results": results, "sent": sent, "failed": len(results) - sent}
+
+
+@app.get("/conversations/{user_id}", dependencies=[limit_reads])
+async def get_message(user_id: str, request: Request, limit: Optional[int] = None, before: Optional[str] = None,
+                      caller: Optional[str] = Depends(authenticated_user)):
+    require_user(caller, user_id)
+    response_payload = await get_service("message_service")
+    if response_payload:
         try:
-            response = requests.get(f'{response_payload["address"]}/conversations/{user_id}')
+            params = {key: value for key, value in {'limit': limit, 'before': before}.items() if value is not None}
+            response = await coalesced_get(f'{response_payload["address"]}/conversations/{user_id}',
+                                           params=params, headers=conditional_headers(request))
 
-            if response.status_code == 200:
-                conversations = response.json()
-                return conversations
+            if response.status_code in (200, 304):
+                return relay_json(response)
+            elif response.status_code == 400:
+                raise HTTPException(status_code=400, detail=response.json().get("detail"))
             else:
                 raise HTTPException(status_code=500, detail="Failed to get conversations")
 
+        except HTTPException:
+            raise
         except Exception as e:
             raise HTTPException(status_code=500, detail=str(e))
     else:
         raise HTTPException(status_code=404, detail="Service not found")
 
 
-@app.get("/get-messages/{conversation_id}")
-async def get_message(conversation_id: str):
-    response = requests.get(f"{REGISTER_SERVICE_URL}/get_service/message_service")
-    response_payload = response.json()
-    print(response_payload)
-    if response_payload["is_active"]:
-        # print("service is registered")
+@app.get("/search/{user_id}", dependencies=[limit_reads])
+async def search_messages(user_id: str, q: str, limit: Optional[int] = None, offset: Optional[int] = None,
+                          conversation_id: Optional[str] = None, caller: Optional[str] = Depends(authenticated_user)):
+    require_user(caller, user_id)
+    response_payload = await get_service("message_service")
+    if response_payload:
         try:
-            response = requests.get(f'{response_payload["address"]}/get-messages/{conversation_id}')
+            params = {'q': q, 'limit': limit, 'offset': offset, 'conversation_id': conversation_id}
+            params = {key: value for key, value in params.items() if value is not None}
+            response = await upstream_request("GET", f'{response_payload["address"]}/search/{user_id}',
+                                              params=params)
 
             if response.status_code == 200:
-                messages = response.json()
-                return messages
+                return response.json()
+            elif response.status_code == 400:
+                raise HTTPException(status_code=400, detail=response.json().get("detail"))
+            else:
+                raise HTTPException(status_code=500, detail="Failed to search messages")
+
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+    else:
+        raise HTTPException(status_code=404, detail="Service not found")
+
+
+@app.post("/conversations/{conversation_id}/read", dependencies=[limit_writes])
+async def read_conversation(conversation_id: str, data: ConversationRead,
+                            caller: Optional[str] = Depends(authenticated_user)):
+    require_user(caller, data.user_id)
+    response_payload = await get_service("message_service")
+    if response_payload:
+        try:
+            response = await upstream_request(
+                "POST", f'{response_payload["address"]}/conversations/{conversation_id}/read',
+                json={'user_id': data.user_id})
+
+            if response.status_code == 200:
+                return {"message": "Conversation marked as read"}
+            elif response.status_code == 404:
+                raise HTTPException(status_code=404, detail="Conversation not found")
+            else:
+                raise HTTPException(status_code=500, detail="Failed to mark conversation as read")
+
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+    else:
+        raise HTTPException(status_code=404, detail="Service not found")
+
+
+@app.get("/get-messages/{conversation_id}", dependencies=[limit_reads])
+async def get_message(conversation_id: str, request: Request, limit: Optional[int] = None,
+                      before: Optional[str] = None, after: Optional[str] = None,
+                      caller: Optional[str] = Depends(authenticated_user)):
+    response_payload = await get_service("message_service")
+    if response_payload:
+        try:
+            # The message service only answers the conversation's participants, and since
+            # the caller is in the params, coalescing only shares a page with the same caller
+            params = {key: value for key, value in
+                      {'limit': limit, 'before': before, 'after': after, 'user_id': caller}.items()
+                      if value is not None}
+            response = await coalesced_get(f'{response_payload["address"]}/get-messages/{conversation_id}',
+                                           params=params, headers=conditional_headers(request))
+
+            if response.status_code in (200, 304):
+                return relay_json(response)
+            elif response.status_code == 400:
+                raise HTTPException(status_code=400, detail=response.json().get("detail"))
+            elif response.status_code == 404:
+                raise HTTPException(status_code=404, detail="Conversation not found")
             else:
                 raise HTTPException(status_code=500, detail="Failed to get messages")
 
+        except HTTPException:
+            raise
         except Exception as e:
             raise HTTPException(status_code=500, detail=str(e))
     else:
         raise HTTPException(status_code=404, detail="Service not found")
 
 
-@app.post("/upload-photo/")
-async def upload_photo(data: PhotoUpload):
-    response = requests.get(f"{REGISTER_SERVICE_URL}/get_service/photo_service")
-    response_payload = response.json()
-    # print(response_payload)
-    if response_payload["is_active"]:
-        print("service is registered")
+# Server-sent events stream of new messages for a user, relayed from the message service
+@app.get("/subscribe/{user_id}", dependencies=[limit_reads])
+async def subscribe(user_id: str, caller: Optional[str] = Depends(authenticated_user)):
+    require_user(caller, user_id)
+    response_payload = await get_service("message_service")
+    if response_payload:
         try:
-            image_bytes = base64.b64decode(data.image.encode('utf-8'))
+            address = subscriber_address(response_payload, user_id)
+            request = stream_client.build_request("GET", f'{address}/subscribe/{user_id}')
+            response = await stream_client.send(request, stream=True)
+        except httpx.ConnectError as e:
+            invalidate_service_address(address)
+            raise HTTPException(status_code=500, detail=str(e))
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+
+        if response.status_code != 200:
+            await response.aclose()
+            raise HTTPException(status_code=500, detail="Failed to subscribe")
+        return StreamingResponse(response.aiter_raw(), media_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+                                 background=BackgroundTask(response.aclose))
+    else:
+        raise HTTPException(status_code=404, detail="Service not found")
 
+
+@app.post("/upload-photo/", dependencies=[limit_uploads, Depends(authenticated_user)])
+async def upload_photo(data: PhotoUpload):
+    response_payload = await get_service("photo_service")
+    if response_payload:
+        try:
             payload = {
                 'image': data.image,
                 'description': data.description,
@@ -248,21 +1437,52 @@ async def upload_photo(data: PhotoUpload):
                 'uid': "data.uid"
 
             }
-            # print("sm")
-            response = requests.post(response_payload["address"], json=payload)
-            # print("sm")
+            response = await upstream_request("POST", response_payload["address"], json=payload)
 
             if response.status_code == 200:
-                return {"message": "Photo uploaded successfully"}
+                return response.json()
             else:
                 raise HTTPException(status_code=500, detail="Failed to upload photo")
 
+        except HTTPException:
+            raise
         except Exception as e:
             raise HTTPException(status_code=500, detail=str(e))
     else:
         raise HTTPException(status_code=404, detail="Service not found")
 
 
+# Raw body upload for photos, piped to the photo service chunk by chunk
+@app.post("/upload-photo/stream", dependencies=[limit_uploads, Depends(authenticated_user)])
+async def upload_photo_stream(request: Request, description: str, publish_date: int):
+    response_payload = await get_service("photo_service")
+    if response_payload:
+        try:
+            response = await upstream_request(
+                "POST", f'{response_payload["address"].rstrip("/")}/stream',
+                params={'description': description, 'publish_date': publish_date},
+                content=request.stream(),
+                headers=stream_headers(request))
+
+            if response.status_code == 200:
+                return response.json()
+            else:
+                raise HTTPException(status_code=500, detail="Failed to upload photo")
+
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+    else:
+        raise HTTPException(status_code=404, detail="Service not found")
+
+
+@app.api_route("/photo/{upload_id}", methods=["GET", "HEAD"],
+               dependencies=[limit_reads, Depends(authenticated_user)])
+async def get_photo(upload_id: str, request: Request):
+    return await media_proxy("photo_service", f"/{upload_id}", request, "Photo not found")
+
+
 if __name__ == "__main__":
     print("Starting gateway...")
     # uvicorn gateway:app --reload --host 127.0.0.1 --port 8000
@@ -0,0 +1,207 @@
+import asyncio
+import json
+import multiprocessing
+import os
+import sqlite3
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import closing
+
+from starlette.concurrency import run_in_threadpool
+
+# Shared by the media services: post-processing that runs after an upload has
+# been stored, in a bounded process pool, with job state kept in SQLite so
+# pending work survives a restart.
+
+JOB_PROCESSES = int(os.environ.get('MEDIA_JOB_PROCESSES', 2))
+JOB_MAX_ATTEMPTS = int(os.environ.get('MEDIA_JOB_MAX_ATTEMPTS', 3))
+# Seconds before the first retry, doubled for each one after
+JOB_RETRY_DELAY = float(os.environ.get('MEDIA_JOB_RETRY_DELAY', 5.0))
+# Finished jobs are kept this many seconds for the status endpoint
+JOB_RETENTION = float(os.environ.get('MEDIA_JOB_RETENTION', 7 * 24 * 3600))
+JOB_POLL_INTERVAL = float(os.environ.get('MEDIA_JOB_POLL_INTERVAL', 30.0))
+
+
+class JobQueue:
+    """Runs handler(payload) for submitted jobs in a process pool.
+
+    Jobs move pending -> running -> done, or back to pending with a backoff
+    when the handler raises, until they fail for good after `max_attempts`.
+    Jobs found running at startup were cut off by a restart and go back to
+    pending. Handlers must be module-level functions so the pool can pickle
+    them; they receive the JSON payload and return a JSON-able result.
+    """
+
+    def __init__(self, path: str, handlers, metrics, logger, processes: int = JOB_PROCESSES,
+                 max_attempts: int = JOB_MAX_ATTEMPTS, retry_delay: float = JOB_RETRY_DELAY):
+        self.path = path
+        self.handlers = handlers
+        self.metrics = metrics
+        self.logger = logger
+        self.processes = processes
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.pool = None
+        self.workers = []
+        self.wakeup = None
+
+    def connection(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.row_factory = sqlite3.Row
+        return connection
+
+    def init(self):
+        with closing(self.connection()) as connection, connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " id TEXT PRIMARY KEY,"
+                " kind TEXT NOT NULL,"
+                " payload TEXT NOT NULL,"
+                " status TEXT NOT NULL,"
+                " attempts INTEGER NOT NULL DEFAULT 0,"
+                " result TEXT,"
+                " error TEXT,"
+                " run_at REAL NOT NULL,"
+                " created_at REAL NOT NULL,"
+                " updated_at REAL NOT NULL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS ix_jobs_status_run_at ON jobs (status, run_at)")
+            now = time.time()
+            resumed = connection.execute(
+                "UPDATE jobs SET status = 'pending', run_at = ?, updated_at = ? WHERE status = 'running'",
+                (now, now)).rowcount
+            connection.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?",
+                               (now - JOB_RETENTION,))
+        if resumed:
+            self.logger.info("resuming %s interrupted jobs", resumed)
+
+    async def start(self):
+        await run_in_threadpool(self.init)
+        self.pool = self.new_pool()
+        self.wakeup = asyncio.Event()
+        self.workers = [asyncio.create_task(self.work()) for _ in range(self.processes)]
+
+    def new_pool(self):
+        # Forking a process that already runs threads can copy held locks, spawn starts clean
+        return ProcessPoolExecutor(self.processes, mp_context=multiprocessing.get_context("spawn"))
+
+    async def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        if self.pool is not None:
+            # Jobs still running are picked up again at the next start
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+    def insert(self, kind: str, payload: dict):
+        job_id = str(uuid.uuid4())
+        now = time.time()
+        with closing(self.connection()) as connection, connection:
+            connection.execute(
+                "INSERT INTO jobs (id, kind, payload, status, run_at, created_at, updated_at)"
+                " VALUES (?, ?, ?, 'pending', ?, ?, ?)",
+                (job_id, kind, json.dumps(payload), now, now, now))
+        return job_id
+
+    async def submit(self, kind: str, payload: dict):
+        job_id = await run_in_threadpool(self.insert, kind, payload)
+        self.metrics.inc("media_jobs_submitted_total", (("kind", kind),))
+        if self.wakeup is not None:
+            self.wakeup.set()
+        return job_id
+
+    def load(self, job_id: str):
+        with closing(self.connection()) as connection:
+            row = connection.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["payload"] = json.loads(job["payload"])
+        job["result"] = json.loads(job["result"]) if job["result"] is not None else None
+        return job
+
+    async def get(self, job_id: str):
+        return await run_in_threadpool(self.load, job_id)
+
+    def claim(self):
+        # The next due job marked running, or the seconds until one is due
+        now = time.time()
+        with closing(self.connection()) as connection:
+            # Take the write lock up front so two instances never claim the same job
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = connection.execute(
+                    "SELECT * FROM jobs WHERE status = 'pending' ORDER BY run_at LIMIT 1").fetchone()
+                if row is None or row["run_at"] > now:
+                    connection.rollback()
+                    return None, row["run_at"] - now if row is not None else None
+                connection.execute(
+                    "UPDATE jobs SET status = 'running', attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                    (now, row["id"]))
+                connection.commit()
+            except BaseException:
+                connection.rollback()
+                raise
+        job = dict(row)
+        job["attempts"] += 1
+        return job, None
+
+    def finish(self, job, result=None, error: str = None):
+        now = time.time()
+        if error is None:
+            status, run_at = "done", job["run_at"]
+        elif job["attempts"] < self.max_attempts:
+            status, run_at = "pending", now + self.retry_delay * 2 ** (job["attempts"] - 1)
+        else:
+            status, run_at = "failed", job["run_at"]
+        with closing(self.connection()) as connection, connection:
+            connection.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, run_at = ?, updated_at = ? WHERE id = ?",
+                (status, json.dumps(result) if result is not None else None, error, run_at, now, job["id"]))
+        return status
+
+    async def work(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # Cleared before looking, so a job submitted meanwhile still wakes us
+            self.wakeup.clear()
+            try:
+                job, wait = await run_in_threadpool(self.claim)
+            except sqlite3.Error as e:
+                self.logger.warning("claiming a job failed: %s", e)
+                job, wait = None, JOB_POLL_INTERVAL
+            if job is None:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), min(wait or JOB_POLL_INTERVAL, JOB_POLL_INTERVAL))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            kind = job["kind"]
+            started = time.perf_counter()
+            result, error = None, None
+            pool = self.pool
+            try:
+                handler = self.handlers[kind]
+                result = await loop.run_in_executor(pool, handler, json.loads(job["payload"]))
+            except asyncio.CancelledError:
+                # Shutting down: the job stays running and is resumed at the next start
+                raise
+            except BrokenProcessPool as e:
+                error = f"process pool broke: {e}"
+                # A worker process died; the first job to notice replaces the pool
+                if self.pool is pool:
+                    self.pool = self.new_pool()
+                    pool.shutdown(wait=False)
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+            status = await run_in_threadpool(self.finish, job, result, error)
+            self.metrics.inc("media_jobs_total", (("kind", kind), ("status", status)))
+            self.metrics.observe("media_job_duration_seconds", (("kind", kind),), time.perf_counter() - started)
+            if error is not None:
+                self.logger.warning("job %s failed: %s", kind, error,
+                                    extra={"job_id": job["id"], "attempt": job["attempts"], "status": status})
@@ -0,0 +1,186 @@
+import os
+import uuid
+from email.utils import formatdate, parsedate_to_datetime
+
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import Response
+
+# Shared by the media services: GET/HEAD responses for stored files with
+# Range (single and multipart), strong ETags, Last-Modified and 304s.
+
+# Bytes read per chunk when the server cannot send straight from the file
+MEDIA_CHUNK_SIZE = int(os.environ.get('MEDIA_CHUNK_SIZE', 256 * 1024))
+# Requests asking for more ranges than this get the whole file
+MEDIA_MAX_RANGES = int(os.environ.get('MEDIA_MAX_RANGES', 16))
+ZEROCOPY = "http.response.zerocopy"
+
+
+def file_etag(stat_result: os.stat_result):
+    # Files are only ever replaced by a rename, so size and mtime identify the bytes
+    return f'"{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}"'
+
+
+def etag_matches(header: str, etag: str):
+    # Weak comparison, as If-None-Match uses
+    if header.strip() == "*":
+        return True
+    return etag in (candidate.strip().removeprefix("W/") for candidate in header.split(","))
+
+
+def parse_http_date(value: str):
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def not_modified(headers, etag: str, mtime: int):
+    if_none_match = headers.get("if-none-match")
+    if if_none_match is not None:
+        return etag_matches(if_none_match, etag)
+    since = parse_http_date(headers.get("if-modified-since", ""))
+    return since is not None and mtime <= since
+
+
+def range_applies(headers, etag: str, mtime: int):
+    if_range = headers.get("if-range")
+    if if_range is None:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith(('"', "W/")):
+        # Strong comparison, a weak validator never matches
+        return if_range == etag
+    return parse_http_date(if_range) == mtime
+
+
+def parse_range(header: str, size: int):
+    # Inclusive (start, end) pairs; None to ignore the header, [] if nothing is satisfiable
+    unit, _, specs = header.partition("=")
+    if unit.strip().lower() != "bytes" or not specs:
+        return None
+    ranges = []
+    for spec in specs.split(","):
+        first, dash, last = spec.strip().partition("-")
+        if not dash:
+            return None
+        try:
+            if first:
+                start = int(first)
+                end = int(last) if last else start
+                if start > end:
+                    return None
+                if not last:
+                    end = size - 1
+            else:
+                suffix = int(last)
+                if suffix == 0:
+                    continue
+                start, end = max(size - suffix, 0), size - 1
+        except ValueError:
+            return None
+        if start < size:
+            ranges.append((start, min(end, size - 1)))
+    if len(ranges) > MEDIA_MAX_RANGES:
+        return None
+    # Overlapping or adjacent ranges are sent once
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class MediaResponse(Response):
+    """Sends byte ranges of a file, as one body or as multipart/byteranges.
+
+    With the ASGI zero-copy extension the server copies straight from the
+    file; otherwise the file is read with pread in MEDIA_CHUNK_SIZE chunks
+    off the event loop.
+    """
+
+    def __init__(self, path: str, status_code: int, headers: dict, media_type: str,
+                 ranges=(), size: int = 0, send_header_only: bool = False):
+        self.path = path
+        self.status_code = status_code
+        self.media_type = None
+        self.background = None
+        self.send_header_only = send_header_only
+        self.parts = []
+        if len(ranges) > 1:
+            boundary = uuid.uuid4().hex
+            for start, end in ranges:
+                preamble = (f"--{boundary}\r\nContent-Type: {media_type}\r\n"
+                            f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n").encode()
+                self.parts.append((preamble, start, end - start + 1, b"\r\n"))
+            self.epilogue = f"--{boundary}--\r\n".encode()
+            headers["Content-Type"] = f"multipart/byteranges; boundary={boundary}"
+        else:
+            for start, end in ranges:
+                self.parts.append((b"", start, end - start + 1, b""))
+            self.epilogue = b""
+            headers["Content-Type"] = media_type
+        length = sum(len(preamble) + count + len(trailer) for preamble, _, count, trailer in self.parts)
+        headers["Content-Length"] = str(length + len(self.epilogue))
+        self.init_headers(headers)
+
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if self.send_header_only or not self.parts:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+        zerocopy = ZEROCOPY in scope.get("extensions", {})
+        media_file = await run_in_threadpool(open, self.path, "rb")
+        try:
+            for preamble, offset, count, trailer in self.parts:
+                if preamble:
+                    await send({"type": "http.response.body", "body": preamble, "more_body": True})
+                if zerocopy:
+                    await send({"type": ZEROCOPY, "file": media_file, "offset": offset,
+                                "count": count, "more_body": True})
+                else:
+                    while count > 0:
+                        chunk = await run_in_threadpool(
+                            os.pread, media_file.fileno(), min(count, MEDIA_CHUNK_SIZE), offset)
+                        if not chunk:
+                            raise RuntimeError(f"{self.path} was truncated while being sent")
+                        offset += len(chunk)
+                        count -= len(chunk)
+                        await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                if trailer:
+                    await send({"type": "http.response.body", "body": trailer, "more_body": True})
+            await send({"type": "http.response.body", "body": self.epilogue, "more_body": False})
+        finally:
+            await run_in_threadpool(media_file.close)
+
+
+async def media_response(request, path: str, media_type: str, cache_control: str, etag: str = None):
+    # Raises FileNotFoundError when there is nothing stored at `path`
+    stat_result = await run_in_threadpool(os.stat, path)
+    size = stat_result.st_size
+    mtime = int(stat_result.st_mtime)
+    etag = etag or file_etag(stat_result)
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(mtime, usegmt=True),
+        "Cache-Control": cache_control,
+        "Accept-Ranges": "bytes",
+    }
+    if not_modified(request.headers, etag, mtime):
+        return Response(status_code=304, headers=headers)
+
+    send_header_only = request.method == "HEAD"
+    range_header = request.headers.get("range")
+    if range_header and range_applies(request.headers, etag, mtime):
+        ranges = parse_range(range_header, size)
+        if ranges == []:
+            headers["Content-Range"] = f"bytes */{size}"
+            return Response(status_code=416, headers=headers)
+        if ranges:
+            if len(ranges) == 1:
+                start, end = ranges[0]
+                headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+            return MediaResponse(path, 206, headers, media_type, ranges, size, send_header_only)
+    return MediaResponse(path, 200, headers, media_type, [(0, size - 1)] if size else [], size,
+                         send_header_only)
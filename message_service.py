@@ -1,27 +1,74 @@
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-from sqlalchemy import create_engine, Column, Integer, String, Text, VARCHAR, DateTime
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, ValidationError
+from sqlalchemy import Column, Integer, String, Text, VARCHAR, DateTime, Index, tuple_, inspect, text, \
+    select, insert, update, case, exists, func, literal_column
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
 import os
 from dotenv import load_dotenv
+from observability import Metrics, instrument, get_logger
+from common import Registration, async_database_url, pool_options
 import httpx
+import asyncio
 import uuid
-from datetime import datetime
-from typing import Optional
+import base64
+import json
+import hashlib
+import re
+from collections import Counter, OrderedDict, deque
+from datetime import datetime, timedelta
+from typing import List, Optional
 
 # Load environment variables from .env file
 load_dotenv()
 
 # Initialize FastAPI
 app = FastAPI()
+logger = get_logger("message_service")
+metrics = Metrics()
+instrument(app, metrics)
+registration = Registration("message_service", metrics, logger)
+
 
 # SQLAlchemy setup
-DATABASE_URL = os.environ.get('MESSAGE_DATABASE_URL')
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+DATABASE_URL = async_database_url(os.environ.get('MESSAGE_DATABASE_URL'))
+engine = create_async_engine(DATABASE_URL, **pool_options(DATABASE_URL))
+# Rows stay readable after commit, so handlers can return them without another query
+SessionLocal = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
 
+# Page sizes for /get-messages
+DEFAULT_PAGE_SIZE = int(os.environ.get('MESSAGE_PAGE_SIZE', 50))
+MAX_PAGE_SIZE = int(os.environ.get('MESSAGE_MAX_PAGE_SIZE', 200))
+# Characters of the last message kept in the inbox summary
+PREVIEW_LENGTH = int(os.environ.get('MESSAGE_PREVIEW_LENGTH', 100))
+
+# Group commit: buffer sent messages and insert them in batches, one transaction per batch
+GROUP_COMMIT = os.environ.get('MESSAGE_GROUP_COMMIT', '0') == '1'
+GROUP_COMMIT_BATCH_SIZE = int(os.environ.get('MESSAGE_GROUP_COMMIT_BATCH_SIZE', 100))
+GROUP_COMMIT_DEADLINE = float(os.environ.get('MESSAGE_GROUP_COMMIT_DEADLINE_MS', 5)) / 1000
+
+# Most messages accepted by one /send-messages/ call
+MAX_BATCH_SIZE = int(os.environ.get('MESSAGE_MAX_BATCH_SIZE', 500))
+
+# Full-text search: Postgres text search configuration used by the index and the queries
+SEARCH_CONFIG = os.environ.get('MESSAGE_SEARCH_CONFIG', 'simple')
+if not re.fullmatch(r"\w+", SEARCH_CONFIG):
+    raise ValueError(f"Invalid MESSAGE_SEARCH_CONFIG: {SEARCH_CONFIG}")
+MAX_SEARCH_OFFSET = int(os.environ.get('MESSAGE_MAX_SEARCH_OFFSET', 1000))
+
+# Tail cache: newest messages of recently read conversations, kept in memory
+TAIL_CACHE = os.environ.get('MESSAGE_TAIL_CACHE', '1') == '1'
+TAIL_CACHE_MESSAGES = int(os.environ.get('MESSAGE_TAIL_CACHE_MESSAGES', 50))
+TAIL_CACHE_MAX_BYTES = int(os.environ.get('MESSAGE_TAIL_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+
+# Live delivery: per-subscriber buffer and the interval between keep-alive comments
+SUBSCRIBER_QUEUE_SIZE = int(os.environ.get('MESSAGE_SUBSCRIBER_QUEUE_SIZE', 100))
+SUBSCRIBER_KEEPALIVE = float(os.environ.get('MESSAGE_SUBSCRIBER_KEEPALIVE', 15.0))
+
 
 # Pydantic model for message
 class Message(BaseModel):
@@ -31,12 +78,23 @@ class Message(BaseModel):
     conversation_id: Optional[str] = None
 
 
+# Pydantic model for a batch of messages; items are validated one by one so a bad
+# item fails alone
+class MessageBatch(BaseModel):
+    messages: List[dict]
+
+
 # Pydantic model for creating conversation
 class ConversationCreate(BaseModel):
     user_id: str
     participant_id: str
 
 
+# Pydantic model for marking a conversation as read
+class ConversationRead(BaseModel):
+    user_id: str
+
+
 # SQLAlchemy model for message
 class MessageDB(Base):
     __tablename__ = "messages"
@@ -47,6 +105,11 @@ class MessageDB(Base):
     timestamp = Column(DateTime)
     conversation_id = Column(VARCHAR(36))
 
+    # Serves keyset pagination over a conversation without a scan or a sort
+    __table_args__ = (
+        Index("ix_messages_conversation_timestamp_id", "conversation_id", "timestamp", "id"),
+    )
+
 
 # SQLAlchemy model for conversation
 class Conversation(Base):
@@ -54,25 +117,140 @@ class Conversation(Base):
     id = Column(VARCHAR(36), primary_key=True, index=True)
     user_id = Column(VARCHAR(36))
     participant_id = Column(VARCHAR(36))
+    # Both ids in sorted order, one row per pair of users whoever wrote first
+    participants_key = Column(VARCHAR(73), unique=True, index=True)
+    # Bumped with every write to the conversation's messages, used as its ETag
+    version = Column(Integer, nullable=False, default=0, server_default="0")
+
+
+# SQLAlchemy model for one user's inbox entry of a conversation, kept up to date on every send
+class ConversationSummary(Base):
+    __tablename__ = "conversation_summaries"
+    conversation_id = Column(VARCHAR(36), primary_key=True)
+    user_id = Column(VARCHAR(36), primary_key=True)
+    participant_id = Column(VARCHAR(36))
+    last_message_id = Column(VARCHAR(36))
+    last_sender_id = Column(VARCHAR(36))
+    last_message_preview = Column(Text)
+    last_activity_at = Column(DateTime)
+    unread_count = Column(Integer, default=0)
+    last_read_at = Column(DateTime)
+
+    # Serves the inbox: a user's conversations, most recently active first
+    __table_args__ = (
+        Index("ix_conversation_summaries_inbox", "user_id", "last_activity_at", "conversation_id"),
+    )
 
 
-# Create tables in the database
-Base.metadata.create_all(bind=engine)
+def participants_key(user_id: str, participant_id: str):
+    return "|".join(sorted((user_id, participant_id)))
+
+
+def summary_rows(conversation_id: str, user_id: str, participant_id: str, last_message=None, created_at=None):
+    # One row per member; a conversation with yourself has a single member
+    rows = []
+    for member, other in {user_id: participant_id, participant_id: user_id}.items():
+        rows.append({
+            "conversation_id": conversation_id,
+            "user_id": member,
+            "participant_id": other,
+            "last_message_id": last_message.id if last_message else None,
+            "last_sender_id": last_message.user_id if last_message else None,
+            "last_message_preview": last_message.content[:PREVIEW_LENGTH] if last_message else None,
+            "last_activity_at": last_message.timestamp if last_message else created_at,
+            "unread_count": 0,
+        })
+    return rows
+
+
+# Add and backfill conversations.participants_key on databases created before it existed.
+# Duplicate conversations for the same pair are merged into one, their messages moved over.
+def migrate_participants_key(connection):
+    columns = [column["name"] for column in inspect(connection).get_columns("conversations")]
+    if "participants_key" not in columns:
+        connection.execute(text("ALTER TABLE conversations ADD COLUMN participants_key VARCHAR(73)"))
+
+    kept = dict(connection.execute(text(
+        "SELECT participants_key, id FROM conversations WHERE participants_key IS NOT NULL")).all())
+    rows = connection.execute(text(
+        "SELECT id, user_id, participant_id FROM conversations WHERE participants_key IS NULL ORDER BY id")).all()
+    for conversation_id, user_id, participant_id in rows:
+        key = participants_key(user_id, participant_id)
+        if key in kept:
+            connection.execute(text("UPDATE messages SET conversation_id = :kept WHERE conversation_id = :id"),
+                               {"kept": kept[key], "id": conversation_id})
+            connection.execute(text("DELETE FROM conversations WHERE id = :id"), {"id": conversation_id})
+        else:
+            connection.execute(text("UPDATE conversations SET participants_key = :key WHERE id = :id"),
+                               {"key": key, "id": conversation_id})
+            kept[key] = conversation_id
+
+
+def migrate_conversation_version(connection):
+    columns = [column["name"] for column in inspect(connection).get_columns("conversations")]
+    if "version" not in columns:
+        connection.execute(text("ALTER TABLE conversations ADD COLUMN version INTEGER NOT NULL DEFAULT 0"))
+
+
+# Build inbox summaries for conversations that predate them. Read state was not
+# tracked before, so they start with nothing unread.
+def migrate_conversation_summaries(connection):
+    conversations = connection.execute(
+        select(Conversation.id, Conversation.user_id, Conversation.participant_id).where(
+            ~exists().where(ConversationSummary.conversation_id == Conversation.id))
+    ).all()
+    for conversation in conversations:
+        last_message = connection.execute(
+            select(MessageDB).where(MessageDB.conversation_id == conversation.id)
+            .order_by(MessageDB.timestamp.desc(), MessageDB.id.desc()).limit(1)
+        ).first()
+        connection.execute(insert(ConversationSummary), summary_rows(
+            conversation.id, conversation.user_id, conversation.participant_id,
+            last_message, datetime.utcnow()))
+
+
+def create_indexes(connection):
+    # create_all skips indexes of tables that already exist
+    for index in [*MessageDB.__table__.indexes, *Conversation.__table__.indexes]:
+        index.create(connection, checkfirst=True)
+    # Inverted index for message search; the expression must match search_vector()
+    if connection.dialect.name == "postgresql":
+        connection.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_messages_content_search ON messages "
+            f"USING gin (to_tsvector('{SEARCH_CONFIG}', content))"))
+
+
+# Create tables in the database and bring older schemas up to date
+async def init_db():
+    async with engine.begin() as connection:
+        await connection.run_sync(Base.metadata.create_all)
+        await connection.run_sync(migrate_participants_key)
+        await connection.run_sync(migrate_conversation_version)
+        await connection.run_sync(create_indexes)
+        await connection.run_sync(migrate_conversation_summaries)
+
+
+# Find the conversation between two users with one lookup on the unique pair key
+async def get_conversation(db_session, user_id: str, participant_id: str):
+    return await db_session.scalar(select(Conversation).where(
+        Conversation.participants_key == participants_key(user_id, participant_id)
+    ))
 
 
 # Create a new message
-def create_message(db_session, message: Message):
+async def create_message(db_session, message: Message):
     # Check if the conversation already exists between sender and recipient
-    conversation = db_session.query(Conversation).filter(
-        ((Conversation.user_id == message.user_id) & (Conversation.participant_id == message.participant_id)) |
-        ((Conversation.user_id == message.participant_id) & (Conversation.participant_id == message.user_id))
-    ).first()
+    conversation = await get_conversation(db_session, message.user_id, message.participant_id)
 
     # If conversation exists, use its ID, otherwise create a new conversation
     if conversation:
         conversation_id = conversation.id
     else:
-        conversation = create_conversation(db_session, message.user_id, message.participant_id)
+        try:
+            conversation = await create_conversation(db_session, message.user_id, message.participant_id)
+        except HTTPException:
+            # Another request created it first
+            conversation = await get_conversation(db_session, message.user_id, message.participant_id)
         conversation_id = conversation.id
 
     # Create the message with the associated conversation ID
@@ -85,18 +263,23 @@ def create_message(db_session, message: Message):
         conversation_id=conversation_id
     )
     db_session.add(db_message)
-    db_session.commit()
-    db_session.refresh(db_message)
+    await update_summaries(db_session, [{
+        "id": db_message.id,
+        "user_id": db_message.user_id,
+        "content": db_message.content,
+        "timestamp": db_message.timestamp,
+        "conversation_id": db_message.conversation_id,
+    }])
+    versions = await bump_versions(db_session, [conversation_id])
+    await db_session.commit()
+    tail_cache.append(message_row(db_message), versions.get(conversation_id))
     return db_message
 
 
 # Create a new conversation
-def create_conversation(db_session, user_id: str, participant_id: str):
+async def create_conversation(db_session, user_id: str, participant_id: str):
     # Check if a conversation already exists between the provided user_id and participant_id
-    existing_conversation = db_session.query(Conversation).filter(
-        ((Conversation.user_id == user_id) & (Conversation.participant_id == participant_id)) |
-        ((Conversation.user_id == participant_id) & (Conversation.participant_id == user_id))
-    ).first()
+    existing_conversation = await get_conversation(db_session, user_id, participant_id)
     if existing_conversation:
         raise HTTPException(status_code=409, detail="Conversation already exists")
 
@@ -104,61 +287,678 @@ def create_conversation(db_session, user_id: str, participant_id: str):
     db_conversation = Conversation(
         id=str(uuid.uuid4()),
         user_id=user_id,
-        participant_id=participant_id
+        participant_id=participant_id,
+        participants_key=participants_key(user_id, participant_id)
     )
     db_session.add(db_conversation)
-    db_session.commit()
-    db_session.refresh(db_conversation)
+    db_session.add_all(ConversationSummary(**row) for row in summary_rows(
+        db_conversation.id, user_id, participant_id, created_at=datetime.utcnow()))
+    try:
+        await db_session.commit()
+    except IntegrityError:
+        # The unique pair key lost a race with a concurrent insert
+        await db_session.rollback()
+        raise HTTPException(status_code=409, detail="Conversation already exists")
     return db_conversation
 
 
-# Retrieve messages for a conversation
-def get_messages_for_conversation(db_session, conversation_id: str):
-    messages = db_session.query(MessageDB).filter(
-        MessageDB.conversation_id == conversation_id
-    ).all()
-    return messages
+# Map the participants_key of each (user_id, participant_id) pair to its conversation id
+# with one query, adding the conversations that do not exist yet to the caller's
+# transaction. Must run first in that transaction: losing a race on the pair key rolls
+# it back and looks again.
+async def resolve_conversations(db_session, pairs):
+    keys = {participants_key(user_id, participant_id): (user_id, participant_id)
+            for user_id, participant_id in pairs}
+    for attempt in range(3):
+        conversation_ids = dict((await db_session.execute(
+            select(Conversation.participants_key, Conversation.id).where(Conversation.participants_key.in_(keys))
+        )).all())
+        missing = {key: pair for key, pair in keys.items() if key not in conversation_ids}
+        if not missing:
+            break
+        created = {key: str(uuid.uuid4()) for key in missing}
+        now = datetime.utcnow()
+        try:
+            await db_session.execute(insert(Conversation), [{
+                "id": created[key],
+                "user_id": user_id,
+                "participant_id": participant_id,
+                "participants_key": key,
+            } for key, (user_id, participant_id) in missing.items()])
+            await db_session.execute(insert(ConversationSummary), [
+                row for key, (user_id, participant_id) in missing.items()
+                for row in summary_rows(created[key], user_id, participant_id, created_at=now)])
+        except IntegrityError:
+            await db_session.rollback()
+            if attempt == 2:
+                raise
+            continue
+        conversation_ids.update(created)
+        break
+    # Both directions of a pair share the key, so look rows up by participants_key
+    return {key: conversation_ids[key] for key in keys}
+
+
+# Insert many messages with one multi-row INSERT and one commit
+async def create_messages(db_session, messages, timestamps=None):
+    conversation_ids = await resolve_conversations(
+        db_session, [(message.user_id, message.participant_id) for message in messages])
+    timestamps = timestamps or [datetime.utcnow()] * len(messages)
+    rows = [{
+        "id": str(uuid.uuid4()),
+        "user_id": message.user_id,
+        "participant_id": message.participant_id,
+        "content": message.content,
+        "timestamp": timestamp,
+        "conversation_id": conversation_ids[participants_key(message.user_id, message.participant_id)],
+    } for message, timestamp in zip(messages, timestamps)]
+    await db_session.execute(insert(MessageDB), rows)
+    await update_summaries(db_session, rows)
+    versions = await bump_versions(db_session, {row["conversation_id"] for row in rows})
+    await db_session.commit()
+    for row in rows:
+        tail_cache.append(row, versions.get(row["conversation_id"]))
+    return rows
+
+
+# Move each conversation's summary to its newest message and bump unread counts,
+# one UPDATE per conversation touched, in the caller's transaction
+async def update_summaries(db_session, rows):
+    by_conversation = {}
+    for row in rows:
+        by_conversation.setdefault(row["conversation_id"], []).append(row)
+
+    for conversation_id, conversation_rows in by_conversation.items():
+        last = max(conversation_rows, key=lambda row: (row["timestamp"], row["id"]))
+        sent = Counter(row["user_id"] for row in conversation_rows)
+        # A concurrent send may already have moved the summary past this batch
+        newer = ConversationSummary.last_message_id.is_(None) | \
+            (ConversationSummary.last_activity_at <= last["timestamp"])
+
+        await db_session.execute(update(ConversationSummary).where(
+            ConversationSummary.conversation_id == conversation_id
+        ).values({
+            # Everyone gets the messages the others sent as unread
+            ConversationSummary.unread_count: ConversationSummary.unread_count + len(conversation_rows)
+            - case(sent, value=ConversationSummary.user_id, else_=0),
+            ConversationSummary.last_message_id: case(
+                (newer, last["id"]), else_=ConversationSummary.last_message_id),
+            ConversationSummary.last_sender_id: case(
+                (newer, last["user_id"]), else_=ConversationSummary.last_sender_id),
+            ConversationSummary.last_message_preview: case(
+                (newer, last["content"][:PREVIEW_LENGTH]), else_=ConversationSummary.last_message_preview),
+            ConversationSummary.last_activity_at: case(
+                (newer, last["timestamp"]), else_=ConversationSummary.last_activity_at),
+        }).execution_options(synchronize_session=False))
+
+
+# Invalidate the ETags of conversations whose messages changed, in the caller's transaction.
+# Returns the new version of each conversation.
+async def bump_versions(db_session, conversation_ids):
+    result = await db_session.execute(update(Conversation).where(Conversation.id.in_(conversation_ids)).values({
+        Conversation.version: Conversation.version + 1,
+    }).returning(Conversation.id, Conversation.version).execution_options(synchronize_session=False))
+    return dict(result.all())
+
+
+async def get_conversation_version(db_session, conversation_id: str):
+    return await db_session.scalar(select(Conversation.version).where(Conversation.id == conversation_id))
+
+
+# The version, read through the member's summary row; None if user_id is not in the conversation
+async def get_member_version(db_session, conversation_id: str, user_id: str):
+    return await db_session.scalar(select(Conversation.version).join(
+        ConversationSummary, ConversationSummary.conversation_id == Conversation.id
+    ).where((Conversation.id == conversation_id) & (ConversationSummary.user_id == user_id)))
+
+
+def etag_matches(request: Request, etag: str):
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    return if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]
+
+
+async def mark_conversation_read(db_session, conversation_id: str, user_id: str):
+    result = await db_session.execute(update(ConversationSummary).where(
+        (ConversationSummary.conversation_id == conversation_id) & (ConversationSummary.user_id == user_id)
+    ).values({
+        ConversationSummary.unread_count: 0,
+        ConversationSummary.last_read_at: datetime.utcnow(),
+    }).execution_options(synchronize_session=False))
+    if not result.rowcount:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    await db_session.commit()
+
+
+def message_row(message):
+    return {
+        "id": message.id,
+        "user_id": message.user_id,
+        "participant_id": message.participant_id,
+        "content": message.content,
+        "timestamp": message.timestamp,
+        "conversation_id": message.conversation_id,
+    }
+
+
+class TailCache:
+    """Keeps the newest messages of hot conversations in memory.
+
+    Every cached conversation holds a ring buffer of up to `size` messages,
+    oldest first, and whether that buffer reaches back to the start of the
+    conversation. Conversations are evicted least recently used first once
+    the estimated size of all buffers passes `max_bytes`.
+
+    The cache is filled by first-page reads and kept current by appending
+    committed messages to conversations that are already cached.
+
+    Writes may land on another instance, so every buffer carries the
+    conversation version it matches. A read only uses it when that is still
+    the version in the database, and a local write only extends it when it
+    is the next version; anything else drops the buffer.
+    """
+
+    # Rough per-message overhead of the dict and its fields, on top of the content
+    MESSAGE_OVERHEAD = 400
+
+    def __init__(self, size: int, max_bytes: int, enabled: bool = True):
+        self.size = size
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.conversations = OrderedDict()
+        self.bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        # Write sequence per recently written conversation, so a read that raced
+        # a write does not cache a tail missing that write
+        self.sequence = 0
+        self.last_writes = OrderedDict()
+
+    def message_bytes(self, message):
+        return self.MESSAGE_OVERHEAD + len(message["content"] or "")
+
+    def first_page(self, conversation_id: str, limit: int, version: int):
+        entry = self.conversations.get(conversation_id) if self.enabled else None
+        if entry is not None and entry["version"] != version:
+            self.discard(conversation_id)
+            entry = None
+        if entry is None or (len(entry["messages"]) < limit and not entry["complete"]):
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        self.conversations.move_to_end(conversation_id)
+        messages = list(entry["messages"])[-limit:]
+        has_more = len(entry["messages"]) > limit or not entry["complete"]
+        return messages, has_more
+
+    def fill(self, conversation_id: str, messages, complete: bool, sequence: int, version: int):
+        # `version` was read before the messages, so the buffer is never newer than it claims
+        if not self.enabled or self.last_writes.get(conversation_id, 0) > sequence:
+            return
+        self.discard(conversation_id)
+        entry = {"messages": deque(maxlen=self.size), "complete": complete, "bytes": 0, "version": version}
+        for message in messages[-self.size:]:
+            entry["messages"].append(message)
+            entry["bytes"] += self.message_bytes(message)
+        if len(messages) > self.size:
+            entry["complete"] = False
+        self.conversations[conversation_id] = entry
+        self.bytes += entry["bytes"]
+        self.evict()
+
+    def append(self, message, version: int):
+        if not self.enabled:
+            return
+        conversation_id = message["conversation_id"]
+        self.sequence += 1
+        self.last_writes[conversation_id] = self.sequence
+        self.last_writes.move_to_end(conversation_id)
+        while len(self.last_writes) > 10000:
+            self.last_writes.popitem(last=False)
+
+        entry = self.conversations.get(conversation_id)
+        if entry is None:
+            return
+        # The same version is another row of that write, or a read that already saw it
+        if version is None or entry["version"] is None or version - entry["version"] not in (0, 1):
+            self.discard(conversation_id)
+            return
+        entry["version"] = version
+        messages = entry["messages"]
+        if any(cached["id"] == message["id"] for cached in messages):
+            return
+        if len(messages) == messages.maxlen:
+            entry["bytes"] -= self.message_bytes(messages[0])
+            self.bytes -= self.message_bytes(messages[0])
+            entry["complete"] = False
+        messages.append(message)
+        key = lambda row: (row["timestamp"], row["id"])
+        if len(messages) > 1 and key(messages[-2]) > key(message):
+            # Commits can land slightly out of timestamp order
+            ordered = sorted(messages, key=key)
+            messages.clear()
+            messages.extend(ordered)
+        entry["bytes"] += self.message_bytes(message)
+        self.bytes += self.message_bytes(message)
+        self.evict()
+
+    def discard(self, conversation_id: str):
+        entry = self.conversations.pop(conversation_id, None)
+        if entry is not None:
+            self.bytes -= entry["bytes"]
+
+    def evict(self):
+        while self.bytes > self.max_bytes and self.conversations:
+            _, entry = self.conversations.popitem(last=False)
+            self.bytes -= entry["bytes"]
+            self.stats["evictions"] += 1
+
+    def info(self):
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "hit_rate": self.stats["hits"] / lookups if lookups else 0.0,
+            "conversations": len(self.conversations),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+        }
+
+
+tail_cache = TailCache(TAIL_CACHE_MESSAGES, TAIL_CACHE_MAX_BYTES, TAIL_CACHE)
+
+
+class MessageWriter:
+    """Collects messages from concurrent requests and commits them in batches.
+
+    A batch is flushed when it reaches GROUP_COMMIT_BATCH_SIZE messages or
+    GROUP_COMMIT_DEADLINE after its first message, whichever comes first.
+    Each caller waits until the batch holding its message has committed.
+    """
+
+    def __init__(self, batch_size: int, deadline: float):
+        self.batch_size = batch_size
+        self.deadline = deadline
+        self.queue = asyncio.Queue()
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def submit(self, message: Message):
+        future = asyncio.get_running_loop().create_future()
+        # Stamp on arrival so messages keep their send order inside a batch
+        await self.queue.put((message, datetime.utcnow(), future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            flush_at = loop.time() + self.deadline
+            while len(batch) < self.batch_size:
+                remaining = flush_at - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            await self.flush(batch)
+
+    async def flush(self, batch):
+        try:
+            rows = await self.write([message for message, _, _ in batch],
+                                    [timestamp for _, timestamp, _ in batch])
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, _, future), row in zip(batch, rows):
+            if not future.done():
+                future.set_result(row)
+
+    @staticmethod
+    async def write(messages, timestamps):
+        db = SessionLocal()
+        try:
+            return await create_messages(db, messages, timestamps)
+        finally:
+            await db.close()
+
+
+message_writer = MessageWriter(GROUP_COMMIT_BATCH_SIZE, GROUP_COMMIT_DEADLINE)
+
+
+class MessageHub:
+    """Fans committed messages out to the subscribers of both participants.
+
+    Subscribers are per process. The gateway sends a user's subscription and
+    the messages addressed to them to the same instance, so recipients see
+    every message live; a sender's own other sessions only see their sends
+    when they hash to the same instance.
+
+    Each subscriber owns a bounded queue. A subscriber that falls
+    SUBSCRIBER_QUEUE_SIZE messages behind is disconnected rather than
+    letting its backlog grow; the client reconnects and pages the gap in
+    through /get-messages.
+    """
+
+    def __init__(self, queue_size: int):
+        self.queue_size = queue_size
+        self.subscribers = {}
+
+    def subscribe(self, user_id: str):
+        queue = asyncio.Queue(self.queue_size)
+        self.subscribers.setdefault(user_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, user_id: str, queue):
+        queues = self.subscribers.get(user_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self.subscribers[user_id]
+
+    def publish(self, message):
+        message = jsonable_encoder(message)
+        for user_id in {message["user_id"], message["participant_id"]}:
+            for queue in list(self.subscribers.get(user_id, ())):
+                try:
+                    queue.put_nowait(message)
+                except asyncio.QueueFull:
+                    # None tells the stream to close
+                    self.unsubscribe(user_id, queue)
+                    queue.get_nowait()
+                    queue.put_nowait(None)
+
+    def count(self):
+        return sum(len(queues) for queues in self.subscribers.values())
+
+
+message_hub = MessageHub(SUBSCRIBER_QUEUE_SIZE)
+
+
+async def message_events(request: Request, user_id: str, queue):
+    try:
+        yield ": subscribed\n\n"
+        while True:
+            try:
+                message = await asyncio.wait_for(queue.get(), SUBSCRIBER_KEEPALIVE)
+            except asyncio.TimeoutError:
+                if await request.is_disconnected():
+                    break
+                yield ": keep-alive\n\n"
+                continue
+            if message is None:
+                break
+            yield f"id: {message['id']}\nevent: message\ndata: {json.dumps(message)}\n\n"
+    finally:
+        message_hub.unsubscribe(user_id, queue)
 
 
-# Retrieve conversations for a user
-def get_conversations_for_user(db_session, user_id: str):
-    conversations = db_session.query(Conversation).filter(
-        (Conversation.user_id == user_id) | (Conversation.participant_id == user_id)
-    ).all()
-    return conversations
+# Cursors are an opaque encoding of a (timestamp, id) keyset
+def encode_cursor(timestamp: datetime, key_id: str):
+    key = f"{timestamp.isoformat()}|{key_id}"
+    return base64.urlsafe_b64encode(key.encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    try:
+        timestamp, message_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|", 1)
+        return datetime.fromisoformat(timestamp), message_id
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+# Retrieve one page of messages for a conversation, oldest first within the page.
+# Without a cursor this is the newest page; `before` pages back, `after` pages forward.
+async def get_messages_for_conversation(db_session, conversation_id: str, limit: int = DEFAULT_PAGE_SIZE,
+                                        before: Optional[str] = None, after: Optional[str] = None,
+                                        version: Optional[int] = None):
+    if before and after:
+        raise HTTPException(status_code=400, detail="Use either before or after, not both")
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    key = tuple_(MessageDB.timestamp, MessageDB.id)
+
+    # The newest page of a hot conversation comes straight from memory
+    if not before and not after:
+        if version is None:
+            version = await get_conversation_version(db_session, conversation_id)
+        cached = tail_cache.first_page(conversation_id, limit, version)
+        if cached:
+            messages, has_more = cached
+            return message_page(messages, has_more, before, after)
+        sequence = tail_cache.sequence
+
+    query = select(MessageDB).where(MessageDB.conversation_id == conversation_id)
+    if after:
+        query = query.where(key > tuple_(*decode_cursor(after)))
+        query = query.order_by(MessageDB.timestamp.asc(), MessageDB.id.asc())
+    else:
+        if before:
+            query = query.where(key < tuple_(*decode_cursor(before)))
+        query = query.order_by(MessageDB.timestamp.desc(), MessageDB.id.desc())
+
+    # One extra row tells us whether there is another page in that direction
+    messages = list(await db_session.scalars(query.limit(limit + 1)))
+    has_more = len(messages) > limit
+    messages = [message_row(message) for message in messages[:limit]]
+    if not after:
+        messages.reverse()
+    if not before and not after:
+        tail_cache.fill(conversation_id, messages, not has_more, sequence, version)
+
+    return message_page(messages, has_more, before, after)
+
+
+def message_page(messages, has_more: bool, before: Optional[str], after: Optional[str]):
+    return {
+        "messages": messages,
+        "has_more": has_more,
+        "before": encode_cursor(messages[0]["timestamp"], messages[0]["id"]) if messages else before,
+        "after": encode_cursor(messages[-1]["timestamp"], messages[-1]["id"]) if messages else after,
+    }
+
+
+def search_vector():
+    return func.to_tsvector(literal_column(f"'{SEARCH_CONFIG}'"), MessageDB.content)
+
+
+# Search the messages of every conversation the user is part of, best match first.
+# Postgres uses the GIN text search index; other databases fall back to a substring match.
+async def search_messages(db_session, user_id: str, q: str, limit: int = DEFAULT_PAGE_SIZE, offset: int = 0,
+                          conversation_id: Optional[str] = None):
+    if not q.strip():
+        raise HTTPException(status_code=400, detail="Empty search query")
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    offset = max(0, min(offset, MAX_SEARCH_OFFSET))
+
+    query = select(MessageDB).join(ConversationSummary, (
+        (ConversationSummary.conversation_id == MessageDB.conversation_id) & (ConversationSummary.user_id == user_id)
+    ))
+    if conversation_id:
+        query = query.where(MessageDB.conversation_id == conversation_id)
+
+    if db_session.bind.dialect.name == "postgresql":
+        ts_query = func.websearch_to_tsquery(literal_column(f"'{SEARCH_CONFIG}'"), q)
+        rank = func.ts_rank(search_vector(), ts_query)
+        query = query.add_columns(rank).where(search_vector().op("@@")(ts_query))
+        query = query.order_by(rank.desc(), MessageDB.timestamp.desc(), MessageDB.id.desc())
+    else:
+        pattern = "%" + q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        query = query.add_columns(literal_column("1.0"))
+        query = query.where(MessageDB.content.ilike(pattern, escape="\\"))
+        query = query.order_by(MessageDB.timestamp.desc(), MessageDB.id.desc())
+
+    rows = (await db_session.execute(query.limit(limit + 1).offset(offset))).all()
+    has_more = len(rows) > limit
+    return {
+        "results": [{**message_row(message), "rank": float(rank)} for message, rank in rows[:limit]],
+        "has_more": has_more,
+        "next_offset": offset + limit if has_more else None,
+    }
+
+
+# Retrieve one page of a user's inbox, most recently active conversation first
+async def get_conversations_for_user(db_session, user_id: str, limit: int = DEFAULT_PAGE_SIZE,
+                                     before: Optional[str] = None):
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    query = select(ConversationSummary).where(ConversationSummary.user_id == user_id)
+    if before:
+        query = query.where(tuple_(ConversationSummary.last_activity_at, ConversationSummary.conversation_id)
+                            < tuple_(*decode_cursor(before)))
+    summaries = list(await db_session.scalars(query.order_by(
+        ConversationSummary.last_activity_at.desc(),
+        ConversationSummary.conversation_id.desc()).limit(limit + 1)))
+    has_more = len(summaries) > limit
+    summaries = summaries[:limit]
+
+    return {
+        "conversations": [{
+            "id": summary.conversation_id,
+            "participant_id": summary.participant_id,
+            "last_message": {
+                "id": summary.last_message_id,
+                "user_id": summary.last_sender_id,
+                "content": summary.last_message_preview,
+            } if summary.last_message_id else None,
+            "last_activity_at": summary.last_activity_at,
+            "unread_count": summary.unread_count,
+            "last_read_at": summary.last_read_at,
+        } for summary in summaries],
+        "has_more": has_more,
+        "before": encode_cursor(summaries[-1].last_activity_at, summaries[-1].conversation_id)
+        if summaries else before,
+    }
 
 
 # API endpoint to send a message
 @app.post("/send-message/")
 async def send_message(message: Message):
+    if GROUP_COMMIT:
+        db_message = await message_writer.submit(message)
+        message_hub.publish(db_message)
+        return db_message
     db = SessionLocal()
     try:
-        db_message = create_message(db, message)
+        db_message = await create_message(db, message)
+        message_hub.publish(db_message)
         return db_message
     finally:
-        db.close()
-
-
-# API endpoint to retrieve messages for a conversation
+        await db.close()
+
+
+# API endpoint to send many messages in one transaction, with a result per item
+@app.post("/send-messages/")
+async def send_messages(batch: MessageBatch):
+    if len(batch.messages) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_SIZE} messages per batch")
+    results = {}
+    valid = []
+    for index, item in enumerate(batch.messages):
+        try:
+            valid.append((index, Message.parse_obj(item)))
+        except ValidationError as e:
+            results[index] = {"index": index, "status": 422, "error": e.errors()}
+
+    if valid:
+        # Spread the timestamps so messages keep their batch order within a conversation
+        now = datetime.utcnow()
+        timestamps = [now + timedelta(microseconds=offset) for offset in range(len(valid))]
+        db = SessionLocal()
+        try:
+            rows = await create_messages(db, [message for _, message in valid], timestamps)
+        finally:
+            await db.close()
+        for (index, _), row in zip(valid, rows):
+            message_hub.publish(row)
+            results[index] = {"index": index, "status": 200, "message": row}
+
+    return {
+        "results": [results[index] for index in range(len(batch.messages))],
+        "sent": len(valid),
+        "failed": len(batch.messages) - len(valid),
+    }
+
+
+# API endpoint streaming new messages to or from a user as server-sent events
+@app.get("/subscribe/{user_id}")
+async def subscribe(user_id: str, request: Request):
+    queue = message_hub.subscribe(user_id)
+    return StreamingResponse(message_events(request, user_id, queue), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+# API endpoint to retrieve messages for a conversation. The ETag is the conversation's
+# version, read before the page so a write racing the read only makes the tag stale.
+# With a user_id only that conversation's participants get an answer.
 @app.get("/get-messages/{conversation_id}")
-async def get_messages(conversation_id: str):
+async def get_messages(conversation_id: str, request: Request, response: Response, limit: int = DEFAULT_PAGE_SIZE,
+                       before: Optional[str] = None, after: Optional[str] = None, user_id: Optional[str] = None):
     db = SessionLocal()
     try:
-        messages = get_messages_for_conversation(db, conversation_id)
+        if user_id is not None:
+            version = await get_member_version(db, conversation_id, user_id)
+            if version is None:
+                raise HTTPException(status_code=404, detail="Conversation not found")
+        else:
+            version = await get_conversation_version(db, conversation_id)
+        etag = f'W/"{conversation_id}.{version or 0}"'
+        if etag_matches(request, etag):
+            return Response(status_code=304, headers={"ETag": etag})
+        messages = await get_messages_for_conversation(db, conversation_id, limit, before, after, version)
+        response.headers["ETag"] = etag
         return messages
     finally:
-        db.close()
+        await db.close()
+
+
+# API endpoint to search the messages of a user's conversations
+@app.get("/search/{user_id}")
+async def search(user_id: str, q: str, limit: int = DEFAULT_PAGE_SIZE, offset: int = 0,
+                 conversation_id: Optional[str] = None):
+    db = SessionLocal()
+    try:
+        results = await search_messages(db, user_id, q, limit, offset, conversation_id)
+        return results
+    finally:
+        await db.close()
+
+
+# API endpoint reporting the tail cache hit rate and size
+@app.get("/cache-stats")
+async def cache_stats():
+    return tail_cache.info()
 
 
 # API endpoint to retrieve conversations for a user
 @app.get("/conversations/{user_id}")
-async def list_conversations(user_id: str):
+async def list_conversations(user_id: str, request: Request, response: Response, limit: int = DEFAULT_PAGE_SIZE,
+                             before: Optional[str] = None):
     db = SessionLocal()
     try:
-        conversations = get_conversations_for_user(db, user_id)
+        conversations = await get_conversations_for_user(db, user_id, limit, before)
+        # Read state changes the inbox too, so its ETag is a digest of the page itself
+        digest = hashlib.sha1(json.dumps(jsonable_encoder(conversations), sort_keys=True).encode()).hexdigest()
+        etag = f'W/"{digest}"'
+        if etag_matches(request, etag):
+            return Response(status_code=304, headers={"ETag": etag})
+        response.headers["ETag"] = etag
         return conversations
     finally:
-        db.close()
+        await db.close()
+
+
+# API endpoint to reset a user's unread count for a conversation
+@app.post("/conversations/{conversation_id}/read")
+async def read_conversation(conversation_id: str, data: ConversationRead):
+    db = SessionLocal()
+    try:
+        await mark_conversation_read(db, conversation_id, data.user_id)
+        return {"message": "Conversation marked as read"}
+    finally:
+        await db.close()
 
 
 # Create endpoint for creating conversations
@@ -166,27 +966,18 @@ async def list_conversations(user_id: str):
 async def create_conversation_endpoint(conversation: ConversationCreate):
     db = SessionLocal()
     try:
-        db_conversation = create_conversation(db, conversation.user_id, conversation.participant_id)
+        db_conversation = await create_conversation(db, conversation.user_id, conversation.participant_id)
         return db_conversation
     finally:
-        db.close()
-
-
-async def make_http_request():
-    async with httpx.AsyncClient() as client:
-        payload = {"service_name": "message_service"}  # Add service_name field with a value
-        response = await client.post(os.environ.get('GATEWAY_URL'), json=payload)
-
-        if response.status_code != 200:
-            raise HTTPException(status_code=500,
-                                detail=f"Failed to make HTTP request, status code: {response.status_code}")
-
-        print("successfully registered")
+        await db.close()
 
 
 @app.on_event("startup")
 async def startup_event():
-    await make_http_request()
+    await init_db()
+    if GROUP_COMMIT:
+        message_writer.start()
+    await registration.start()
 
 
 if __name__ == "__main__":
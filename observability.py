@@ -0,0 +1,180 @@
+import json
+import logging
+import os
+import sys
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+from fastapi.responses import PlainTextResponse
+
+# Shared by every service: request metrics in the Prometheus text format on GET /metrics,
+# and leveled JSON logging that drops repeats of a noisy message.
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+# Each message template may be logged LOG_RATE_LIMIT_BURST times per LOG_RATE_LIMIT_INTERVAL seconds
+LOG_RATE_LIMIT_BURST = int(os.environ.get('LOG_RATE_LIMIT_BURST', 10))
+LOG_RATE_LIMIT_INTERVAL = float(os.environ.get('LOG_RATE_LIMIT_INTERVAL', 10.0))
+
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.buckets[bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """Counters, gauges and latency histograms keyed by name and label values.
+
+    Labels are passed as a tuple of (name, value) pairs in a fixed order, so
+    recording is a dict lookup. render() produces the Prometheus text format.
+    """
+
+    def __init__(self):
+        self.types = {}
+        self.values = defaultdict(float)
+        self.histograms = defaultdict(Histogram)
+        self.inflight = 0
+
+    def inc(self, name: str, labels=(), value: float = 1):
+        self.types.setdefault(name, "counter")
+        self.values[name, labels] += value
+
+    def add(self, name: str, labels=(), value: float = 1):
+        self.types.setdefault(name, "gauge")
+        self.values[name, labels] += value
+
+    def observe(self, name: str, labels, seconds: float):
+        self.types.setdefault(name, "histogram")
+        self.histograms[name, labels].observe(seconds)
+
+    def render(self):
+        lines = [
+            "# TYPE http_requests_in_flight gauge",
+            f"http_requests_in_flight {self.inflight}",
+        ]
+        for name, kind in sorted(self.types.items()):
+            lines.append(f"# TYPE {name} {kind}")
+            if kind != "histogram":
+                for (key, labels), value in self.values.items():
+                    if key == name:
+                        lines.append(f"{name}{format_labels(labels)} {value:g}")
+                continue
+            for (key, labels), histogram in self.histograms.items():
+                if key != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip((*LATENCY_BUCKETS, "+Inf"), histogram.buckets):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{format_labels((*labels, ('le', str(bound))))} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum:.6f}")
+                lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in labels) + "}"
+
+
+def instrument(app, metrics: Metrics):
+    # Routes are labelled with their template, so /get-messages/{conversation_id} is one series
+    route_paths = {}
+
+    @app.middleware("http")
+    async def record_request(request, call_next):
+        metrics.inflight += 1
+        started = time.perf_counter()
+        status = 500
+        try:
+            response = await call_next(request)
+            status = response.status_code
+            return response
+        finally:
+            metrics.inflight -= 1
+            endpoint = request.scope.get("endpoint")
+            if endpoint is not None and endpoint not in route_paths:
+                route_paths.update((route.endpoint, route.path) for route in app.routes if hasattr(route, "endpoint"))
+            route = route_paths.get(endpoint, "unmatched")
+            labels = (("method", request.method), ("route", route))
+            metrics.inc("http_requests_total", (*labels, ("status", str(status))))
+            # Streaming responses are timed to their first byte
+            metrics.observe("http_request_duration_seconds", labels, time.perf_counter() - started)
+
+    @app.get("/metrics", include_in_schema=False)
+    async def metrics_endpoint():
+        return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets each message template through `burst` times per `interval` seconds.
+
+    Records are keyed on the unformatted message, so "heartbeat failed: %s"
+    is one key whatever the error. The first record after a quiet window
+    carries how many were dropped.
+    """
+
+    def __init__(self, burst: int, interval: float):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self.windows = {}
+
+    def filter(self, record):
+        key = (record.name, record.levelno, record.msg)
+        now = time.monotonic()
+        window = self.windows.get(key)
+        if window is None or now - window[0] >= self.interval:
+            if len(self.windows) > 10000:
+                self.windows.clear()
+            if window is not None and window[2]:
+                record.suppressed = window[2]
+            self.windows[key] = [now, 1, 0]
+            return True
+        if window[1] < self.burst:
+            window[1] += 1
+            return True
+        window[2] += 1
+        return False
+
+
+class JsonFormatter(logging.Formatter):
+    # Attributes every LogRecord has; anything else came in through `extra`
+    RESERVED = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+    def format(self, record):
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update((key, value) for key, value in vars(record).items() if key not in self.RESERVED)
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def get_logger(name: str):
+    logger = logging.getLogger(name)
+    if not logger.handlers:
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(JsonFormatter())
+        handler.addFilter(RateLimitFilter(LOG_RATE_LIMIT_BURST, LOG_RATE_LIMIT_INTERVAL))
+        logger.addHandler(handler)
+        logger.setLevel(LOG_LEVEL)
+        logger.propagate = False
+    return logger
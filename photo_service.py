@@ -1,28 +1,241 @@
-from fastapi import FastAPI, HTTPException, Form
+from fastapi import FastAPI, HTTPException, Form, Request
+from starlette.concurrency import run_in_threadpool
 import base64
 from pydantic import BaseModel
 import httpx
+import os
+import tempfile
+import hashlib
+import sqlite3
+import struct
+import time
+import uuid
+from contextlib import closing
+from functools import lru_cache
+from observability import Metrics, instrument, get_logger
+from media import media_response
+from jobs import JobQueue
 
 app = FastAPI()
+logger = get_logger("photo_service")
+metrics = Metrics()
+instrument(app, metrics)
+
+# Photos are stored once per content hash under blobs/ab/cd/<sha256>, uploads
+# only point at a blob from the index, so re-uploads of an image share it
+PHOTOS_DIR = os.environ.get('PHOTO_STORAGE_DIR', 'photos')
+BLOBS_DIR = os.path.join(PHOTOS_DIR, "blobs")
+# Temp files sit on the same filesystem as the blobs so the rename into place is atomic
+TMP_DIR = os.path.join(PHOTOS_DIR, ".tmp")
+INDEX_PATH = os.path.join(PHOTOS_DIR, "index.db")
+# Temp files older than this are left over from a crash
+TMP_FILE_TTL = float(os.environ.get('PHOTO_TMP_FILE_TTL', 3600))
+# Blobs never change once written, so clients may keep them
+PHOTO_CACHE_CONTROL = os.environ.get('PHOTO_CACHE_CONTROL', 'public, max-age=31536000, immutable')
+JOBS_PATH = os.path.join(PHOTOS_DIR, "jobs.db")
+# Enough of the file to find the dimensions behind any EXIF block
+IMAGE_HEADER_SIZE = 256 * 1024
+IMAGE_MEDIA_TYPES = {"jpeg": "image/jpeg", "png": "image/png", "gif": "image/gif"}
 
 class PhotoUpload(BaseModel):
     image: str
     description: str
     publish_date: int
 
+def blob_path(digest: str):
+    return os.path.join(BLOBS_DIR, digest[:2], digest[2:4], digest)
+
+def index_connection():
+    connection = sqlite3.connect(INDEX_PATH, timeout=30)
+    connection.row_factory = sqlite3.Row
+    return connection
+
+def init_storage():
+    os.makedirs(BLOBS_DIR, exist_ok=True)
+    os.makedirs(TMP_DIR, exist_ok=True)
+    now = time.time()
+    for name in os.listdir(TMP_DIR):
+        path = os.path.join(TMP_DIR, name)
+        if now - os.path.getmtime(path) > TMP_FILE_TTL:
+            os.unlink(path)
+
+    with closing(index_connection()) as connection, connection:
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS uploads ("
+            " id TEXT PRIMARY KEY,"
+            " blob TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " description TEXT NOT NULL,"
+            " publish_date INTEGER NOT NULL,"
+            " created_at REAL NOT NULL)")
+        connection.execute("CREATE INDEX IF NOT EXISTS ix_uploads_blob ON uploads (blob)")
+
+def write_chunk(tmp_file, digest, chunk: bytes):
+    digest.update(chunk)
+    tmp_file.write(chunk)
+
+def commit_blob(tmp_path: str, digest: str):
+    # Returns True when the same content was already stored
+    path = blob_path(digest)
+    if os.path.exists(path):
+        os.unlink(tmp_path)
+        return True
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Two uploads of the same image may race here, both temp files hold the same bytes
+    os.replace(tmp_path, path)
+    return False
+
+async def save_stream(stream):
+    # Hash the body while writing it to a temp file, then move it to its content address
+    fd, tmp_path = tempfile.mkstemp(dir=TMP_DIR, suffix=".part")
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            async for chunk in stream:
+                size += len(chunk)
+                await run_in_threadpool(write_chunk, tmp_file, digest, chunk)
+            tmp_file.flush()
+            await run_in_threadpool(os.fsync, tmp_file.fileno())
+        duplicate = await run_in_threadpool(commit_blob, tmp_path, digest.hexdigest())
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    return digest.hexdigest(), size, duplicate
+
+async def single_chunk(data: bytes):
+    yield data
+
+def record_upload(digest: str, size: int, description: str, publish_date: int):
+    upload_id = str(uuid.uuid4())
+    with closing(index_connection()) as connection, connection:
+        connection.execute(
+            "INSERT INTO uploads (id, blob, size, description, publish_date, created_at)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            (upload_id, digest, size, description, publish_date, time.time()))
+    return upload_id
+
+def load_upload(upload_id: str):
+    with closing(index_connection()) as connection:
+        row = connection.execute("SELECT * FROM uploads WHERE id = ?", (upload_id,)).fetchone()
+    return dict(row) if row is not None else None
+
+def jpeg_dimensions(data: bytes):
+    position = 2
+    while position + 9 <= len(data):
+        if data[position] != 0xFF:
+            return None
+        marker = data[position + 1]
+        if marker == 0xFF:
+            position += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            position += 2
+            continue
+        # Start of frame markers, without DHT, JPG and DAC which share the range
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack(">HH", data[position + 5:position + 9])
+            return width, height
+        position += 2 + struct.unpack(">H", data[position + 2:position + 4])[0]
+    return None
+
+def image_info(data: bytes):
+    if data.startswith(b"\x89PNG\r\n\x1a\n") and len(data) >= 24:
+        return "png", struct.unpack(">II", data[16:24])
+    if data[:6] in (b"GIF87a", b"GIF89a") and len(data) >= 10:
+        return "gif", struct.unpack("<HH", data[6:10])
+    if data.startswith(b"\xff\xd8"):
+        return "jpeg", jpeg_dimensions(data)
+    return None, None
+
+# Runs in the job process pool: check the blob still matches its address and read its dimensions
+def process_photo(payload):
+    digest = hashlib.sha256()
+    with open(blob_path(payload["blob"]), "rb") as blob_file:
+        header = blob_file.read(IMAGE_HEADER_SIZE)
+        digest.update(header)
+        for chunk in iter(lambda: blob_file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    if digest.hexdigest() != payload["blob"]:
+        raise ValueError(f"blob {payload['blob']} is corrupt, content hashes to {digest.hexdigest()}")
+    image_format, dimensions = image_info(header)
+    width, height = dimensions or (None, None)
+    return {"format": image_format, "width": width, "height": height}
+
+# Blobs are addressed by content, so a blob's type never changes once sniffed
+@lru_cache(maxsize=4096)
+def blob_media_type(digest: str):
+    with open(blob_path(digest), "rb") as blob_file:
+        image_format, _ = image_info(blob_file.read(32))
+    return IMAGE_MEDIA_TYPES.get(image_format, "application/octet-stream")
+
+job_queue = JobQueue(JOBS_PATH, {"photo": process_photo}, metrics, logger)
+
+async def store_photo(stream, description: str, publish_date: int):
+    digest, size, duplicate = await save_stream(stream)
+    upload_id = await run_in_threadpool(record_upload, digest, size, description, publish_date)
+    metrics.inc("photo_uploads_total", (("duplicate", str(duplicate).lower()),))
+    # A blob is processed once, when it is first stored
+    job_id = None if duplicate else await job_queue.submit("photo", {"blob": digest})
+    return {
+        "message": "Photo uploaded successfully",
+        "upload_id": upload_id,
+        "sha256": digest,
+        "size": size,
+        "duplicate": duplicate,
+        "job_id": job_id,
+    }
+
 @app.post("/photo/")
 async def upload_photo(data: PhotoUpload):
     try: 
-        image_bytes = base64.b64decode(data.image.encode('utf-8'))
- 
-        with open(f"photos/{data.publish_date}.jpg", "wb") as img_file:
-            img_file.write(image_bytes)
+        image_bytes = await run_in_threadpool(base64.b64decode, data.image.encode('utf-8'))
 
-        return {"message": "Photo uploaded successfully"}
+        return await store_photo(single_chunk(image_bytes), data.description, data.publish_date)
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    
+
+@app.post("/photo/stream")
+async def upload_photo_stream(request: Request, description: str, publish_date: int):
+    try:
+        return await store_photo(request.stream(), description, publish_date)
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/photo/jobs/{job_id}")
+async def get_photo_job(job_id: str):
+    job = await job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    del job["payload"]
+    return job
+
+@app.get("/photo/{upload_id}/info")
+async def get_photo_info(upload_id: str):
+    upload = await run_in_threadpool(load_upload, upload_id)
+    if upload is None:
+        raise HTTPException(status_code=404, detail="Photo not found")
+    return upload
+
+@app.api_route("/photo/{upload_id}", methods=["GET", "HEAD"])
+async def get_photo(upload_id: str, request: Request):
+    upload = await run_in_threadpool(load_upload, upload_id)
+    if upload is None:
+        raise HTTPException(status_code=404, detail="Photo not found")
+    try:
+        media_type = await run_in_threadpool(blob_media_type, upload["blob"])
+        # The content hash is the strong validator
+        return await media_response(request, blob_path(upload["blob"]), media_type,
+                                    PHOTO_CACHE_CONTROL, etag=f'"{upload["blob"]}"')
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Photo not found")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 async def make_http_request():
     async with httpx.AsyncClient() as client:
         payload = {"service_name": "photo_service"}  # Add service_name field with a value
@@ -31,11 +244,17 @@ async def make_http_request():
         if response.status_code != 200:
             raise HTTPException(status_code=500, detail=f"Failed to make HTTP request, status code: {response.status_code}")
         
-        print("successfully registered")
+        logger.info("successfully registered")
 
 @app.on_event("startup")
 async def startup_event():
+    await run_in_threadpool(init_storage)
+    await job_queue.start()
     await make_http_request()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await job_queue.stop()
     
 if __name__ == "__main__":
     print("Starting Service...")
@@ -1,10 +1,19 @@
-from fastapi import FastAPI, HTTPException, Form
+from fastapi import FastAPI, HTTPException, Form, Header
 import base64
+import hmac
 from pydantic import BaseModel
 import httpx
+import asyncio
+import itertools
+import random
+import time
+import uuid
+from collections import deque
+from typing import Optional
 
 import os
 from dotenv import load_dotenv
+from observability import Metrics, instrument, get_logger
 
 # Load environment variables from .env file
 load_dotenv()
@@ -14,12 +23,40 @@ VIDEO_SERVICE_URL = os.environ.get('VIDEO_SERVICE_URL')
 PROFANITY_SERVICE_URL = os.environ.get('PROFANITY_SERVICE_URL')
 MESSAGE_SERVICE_URL = os.environ.get('MESSAGE_SERVICE_URL')
 
-photo = False
-video = False
-profanity = False
-message = False
-authentication = False
+# Fallback address for services that register without telling us where they are
+SERVICE_URL_VARIABLES = {
+    "photo_service": 'PHOTO_SERVICE_URL',
+    "video_service": 'VIDEO_SERVICE_URL',
+    "profanity_service": 'PROFANITY_SERVICE_URL',
+    "auth_service": 'AUTH_SERVICE_URL',
+    "message_service": 'MESSAGE_SERVICE_URL',
+}
+
+# Instances that registered with an address must heartbeat within this many seconds
+HEARTBEAT_TTL = float(os.environ.get('REGISTRY_HEARTBEAT_TTL', 15.0))
+# round_robin, least_inflight or power_of_two
+BALANCING_STRATEGY = os.environ.get('REGISTRY_BALANCING_STRATEGY', 'round_robin')
+
+# Watchers further behind than this many events get a full snapshot instead of deltas
+WATCH_HISTORY = int(os.environ.get('REGISTRY_WATCH_HISTORY', 1000))
+WATCH_TIMEOUT = float(os.environ.get('REGISTRY_WATCH_TIMEOUT', 30.0))
+
+# Registering an address or deregistering takes this in the X-Registry-Secret header;
+# unset, only address-less registrations are accepted
+REGISTRY_SECRET = os.environ.get('REGISTRY_SECRET')
+
+# service name -> instance id -> instance
+registry = {name: {} for name in SERVICE_URL_VARIABLES}
+round_robin = {name: itertools.count() for name in SERVICE_URL_VARIABLES}
+
+# Every topology change bumps the revision and is kept for watchers
+registry_revision = 0
+events = deque(maxlen=WATCH_HISTORY)
+events_changed = None
 app = FastAPI()
+logger = get_logger("register_service")
+metrics = Metrics()
+instrument(app, metrics)
 
 
 class GetService(BaseModel):
@@ -30,59 +67,247 @@ class RegisterService(BaseModel):
     service_name: str
 
 
+class InstanceRegister(BaseModel):
+    address: Optional[str] = None
+    instance_id: Optional[str] = None
+    load: float = 0.0
+    inflight: int = 0
+
+
+class Instance:
+    def __init__(self, instance_id: str, address: str, static: bool):
+        self.instance_id = instance_id
+        self.address = address
+        # Static instances come from the env fallback and never expire
+        self.static = static
+        self.last_heartbeat = time.time()
+        self.healthy = True
+        self.load = 0.0
+        self.inflight = 0
+        # Requests handed out since the last heartbeat, so a burst does not all land on one instance
+        self.assigned = 0
+
+    def heartbeat(self, load: float, inflight: int):
+        self.last_heartbeat = time.time()
+        self.load = load
+        self.inflight = inflight
+        self.assigned = 0
+
+    def expired(self, now: float):
+        return not self.static and now - self.last_heartbeat > HEARTBEAT_TTL
+
+    def missed_heartbeat(self, now: float):
+        return not self.static and now - self.last_heartbeat > HEARTBEAT_TTL / 2
+
+    def score(self):
+        return self.inflight + self.assigned
+
+    def to_dict(self):
+        return {
+            "instance_id": self.instance_id,
+            "address": self.address,
+            "last_heartbeat": self.last_heartbeat,
+            "healthy": self.healthy,
+            "load": self.load,
+            "inflight": self.inflight,
+        }
+
+
+def publish(event_type: str, service_name: str, instance: Instance):
+    global registry_revision
+    registry_revision += 1
+    events.append({
+        "revision": registry_revision,
+        "type": event_type,
+        "service_name": service_name,
+        "instance": instance.to_dict(),
+    })
+    if events_changed is not None:
+        events_changed.set()
+    logger.info("%s %s", event_type, service_name, extra={"instance": instance.instance_id,
+                                                          "address": instance.address})
+
+
+def expire_instances():
+    now = time.time()
+    expired = []
+    for service_name, instances in registry.items():
+        for instance_id, instance in list(instances.items()):
+            if instance.expired(now):
+                del instances[instance_id]
+                expired.append((service_name, instance))
+                publish("remove", service_name, instance)
+            elif instance.healthy and instance.missed_heartbeat(now):
+                instance.healthy = False
+                publish("health", service_name, instance)
+    return expired
+
+
+def snapshot():
+    return {
+        "revision": registry_revision,
+        "reset": True,
+        "services": {
+            service_name: [instance.to_dict() for instance in instances.values()]
+            for service_name, instances in registry.items()
+        },
+    }
+
+
+def choose_instance(service_name: str, strategy: str):
+    instances = [instance for instance in registry[service_name].values() if instance.healthy]
+    if not instances:
+        return None
+    if strategy == "least_inflight":
+        instance = min(instances, key=Instance.score)
+    elif strategy == "power_of_two":
+        if len(instances) == 1:
+            instance = instances[0]
+        else:
+            instance = min(random.sample(instances, 2), key=Instance.score)
+    else:
+        instance = instances[next(round_robin[service_name]) % len(instances)]
+    instance.assigned += 1
+    return instance
+
+
+def require_registry_secret(secret: Optional[str]):
+    if not REGISTRY_SECRET or not secret or not hmac.compare_digest(secret, REGISTRY_SECRET):
+        raise HTTPException(status_code=403, detail="Registry secret required")
+
+
 @app.get("/health")
 async def get_service(data: GetService):
     return True
 
 
 @app.get("/get_service/{service_name}")
-async def get_service(service_name: str):
-    print(service_name)
+async def get_service(service_name: str, strategy: Optional[str] = None):
     try:
-        global photo, video, profanity, message, authentication
-        if service_name == "photo_service" and photo:
-            return {"address": str(os.environ.get('PHOTO_SERVICE_URL')), "is_active": True}
-        if service_name == "video_service" and video:
-            return {"address": str(os.environ.get('VIDEO_SERVICE_URL')), "is_active": True}
-        if service_name == "profanity_service" and profanity:
-            return {"address": str(os.environ.get('VIDEO_SERVICE_URL')), "is_active": True}
-        if service_name == "auth_service" and authentication:
-            return {"address": str(os.environ.get('AUTH_SERVICE_URL')), "is_active": True}
-        if service_name == "message_service" and message:
-            return {"address": str(os.environ.get('MESSAGE_SERVICE_URL')), "is_active": True}
-
-        return False
+        if service_name not in registry:
+            return False
+
+        expire_instances()
+        instance = choose_instance(service_name, strategy or BALANCING_STRATEGY)
+        if instance is None:
+            return False
+
+        return {
+            "address": instance.address,
+            "instance_id": instance.instance_id,
+            "instances": [i.address for i in registry[service_name].values() if i.healthy],
+            "is_active": True,
+        }
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get("/instances/{service_name}")
+async def list_instances(service_name: str):
+    if service_name not in registry:
+        raise HTTPException(status_code=404, detail="Service not found")
+    expire_instances()
+    return [instance.to_dict() for instance in registry[service_name].values()]
+
+
+# Registering again with the same instance id acts as a heartbeat
 @app.post("/register_service/{service_name}")
-async def register_service(service_name: str):
+async def register_service(service_name: str, data: Optional[InstanceRegister] = None,
+                           x_registry_secret: Optional[str] = Header(None)):
     try:
-        global photo, video, profanity, message, authentication
-        if service_name == "photo_service":
-            photo = True
-            print(photo)
-            return {"is_active": "True"}
-        if service_name == "video_service":
-            video = True
-            return {"is_active": "True"}
-        if service_name == "profanity_service":
-            profanity = True
-            return {"is_active": "True"}
-        if service_name == "auth_service":
-            authentication = True
-            return {"is_active": "True"}
-        if service_name == "message_service":
-            message = True
-            return {"is_active": "True"}
-
-        return False
+        if service_name not in registry:
+            return False
+
+        data = data or InstanceRegister()
+        instances = registry[service_name]
+        if data.address:
+            require_registry_secret(x_registry_secret)
+            instance_id = data.instance_id or str(uuid.uuid4())
+            static = False
+            address = data.address
+        else:
+            instance_id = "static"
+            static = True
+            address = str(os.environ.get(SERVICE_URL_VARIABLES[service_name]))
+
+        instance = instances.get(instance_id)
+        new_instance = instance is None or instance.address != address
+        if new_instance:
+            instance = Instance(instance_id, address, static)
+            instances[instance_id] = instance
+        recovered = not instance.healthy
+        instance.heartbeat(data.load, data.inflight)
+        instance.healthy = True
+        if new_instance:
+            publish("add", service_name, instance)
+        elif recovered:
+            publish("health", service_name, instance)
+
+        return {"is_active": "True", "instance_id": instance_id, "heartbeat_ttl": HEARTBEAT_TTL,
+                "new_instance": new_instance}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.delete("/register_service/{service_name}/{instance_id}")
+async def deregister_service(service_name: str, instance_id: str, x_registry_secret: Optional[str] = Header(None)):
+    require_registry_secret(x_registry_secret)
+    instance = registry.get(service_name, {}).pop(instance_id, None)
+    if instance is None:
+        raise HTTPException(status_code=404, detail="Instance not found")
+    publish("remove", service_name, instance)
+    return {"is_active": "False"}
+
+
+# Long-poll for topology changes after `revision`. Returns the missed events,
+# or a full snapshot when the watcher is new or too far behind.
+@app.get("/watch")
+async def watch(revision: Optional[int] = None, timeout: Optional[float] = None):
+    global events_changed
+    timeout = min(timeout or WATCH_TIMEOUT, WATCH_TIMEOUT)
+    deadline = time.monotonic() + timeout
+
+    while True:
+        current = registry_revision
+        oldest = events[0]["revision"] if events else current + 1
+        if revision is None or revision > current or revision < oldest - 1:
+            return snapshot()
+        if revision < current:
+            return {
+                "revision": current,
+                "reset": False,
+                "events": [event for event in events if event["revision"] > revision],
+            }
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return {"revision": current, "reset": False, "events": []}
+        if events_changed is None:
+            events_changed = asyncio.Event()
+        waiter = events_changed
+        try:
+            await asyncio.wait_for(waiter.wait(), remaining)
+        except asyncio.TimeoutError:
+            pass
+        if waiter is events_changed and waiter.is_set():
+            # Hand every waiter this wake-up, then arm a fresh event for the next change
+            events_changed = asyncio.Event()
+
+
+async def expire_instances_periodically():
+    while True:
+        await asyncio.sleep(HEARTBEAT_TTL / 2)
+        expire_instances()
+
+
+@app.on_event("startup")
+async def startup_event():
+    asyncio.create_task(expire_instances_periodically())
+
+
 if __name__ == "__main__":
     print("Starting Service...")
-    # uvicorn register_service:app --reload --host 127.0.0.1 --port 8050
\ No newline at end of file
+    # uvicorn register_service:app --reload --host 127.0.0.1 --port 8050
@@ -1,35 +1,295 @@
 
 
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Request
+from starlette.concurrency import run_in_threadpool
 import base64
 from pydantic import BaseModel
 import time
 import httpx
+import os
+import tempfile
+import hashlib
+import struct
+from observability import Metrics, instrument, get_logger
+from media import media_response
+from jobs import JobQueue
+import json
+import uuid
+import asyncio
+from typing import Optional
 
 app = FastAPI()
+logger = get_logger("video_service")
+metrics = Metrics()
+instrument(app, metrics)
+
+# Resumable upload sessions live next to the videos so the rename into place is atomic
+UPLOADS_DIR = "videos/.uploads"
+# Sessions with no activity for this many seconds are deleted
+UPLOAD_SESSION_TTL = float(os.environ.get('UPLOAD_SESSION_TTL', 24 * 3600))
+UPLOAD_GC_INTERVAL = float(os.environ.get('UPLOAD_GC_INTERVAL', 600))
+# Videos can be replaced by a later upload for the same publish date, so they are revalidated daily
+VIDEO_CACHE_CONTROL = os.environ.get('VIDEO_CACHE_CONTROL', 'public, max-age=86400')
+JOBS_PATH = "videos/.jobs.db"
 
 class VideoUpload(BaseModel):
     video: str
     description: str
     publish_date: int
 
+class UploadSessionCreate(BaseModel):
+    description: str
+    publish_date: int
+    size: Optional[int] = None
+
 @app.get("/health")
 async def health_check():
     return {"status": "ok"}
 
+def mp4_boxes(video_file, start: int, end: int):
+    # (type, payload start, end) of the boxes between start and end
+    position = start
+    while position + 8 <= end:
+        video_file.seek(position)
+        size, box_type = struct.unpack(">I4s", video_file.read(8))
+        header = 8
+        if size == 1:
+            size = struct.unpack(">Q", video_file.read(8))[0]
+            header = 16
+        elif size == 0:
+            size = end - position
+        if size < header:
+            return
+        yield box_type, position + header, position + size
+        position += size
+
+def mp4_duration(video_file, size: int):
+    for box_type, start, end in mp4_boxes(video_file, 0, size):
+        if box_type != b"moov":
+            continue
+        for inner_type, inner_start, _ in mp4_boxes(video_file, start, end):
+            if inner_type == b"mvhd":
+                video_file.seek(inner_start)
+                if video_file.read(1)[0] == 1:
+                    video_file.seek(inner_start + 20)
+                    timescale, duration = struct.unpack(">IQ", video_file.read(12))
+                else:
+                    video_file.seek(inner_start + 12)
+                    timescale, duration = struct.unpack(">II", video_file.read(8))
+                return duration / timescale if timescale else None
+    return None
+
+# Runs in the job process pool: checksum the stored video and read its duration
+def process_video(payload):
+    digest = hashlib.sha256()
+    with open(payload["path"], "rb") as video_file:
+        for chunk in iter(lambda: video_file.read(1024 * 1024), b""):
+            digest.update(chunk)
+        size = video_file.tell()
+        try:
+            duration = mp4_duration(video_file, size)
+        except (struct.error, IndexError):
+            duration = None
+    return {"sha256": digest.hexdigest(), "size": size, "duration": duration}
+
+job_queue = JobQueue(JOBS_PATH, {"video": process_video}, metrics, logger)
+
+async def single_chunk(data: bytes):
+    yield data
+
 @app.post("/video/")
 async def upload_video(data: VideoUpload):
     try:
-        video_bytes = base64.b64decode(data.video.encode('utf-8'))
+        video_bytes = await run_in_threadpool(base64.b64decode, data.video.encode('utf-8'))
+
+        path = f"videos/{data.publish_date}.mp4"
+        await save_stream(single_chunk(video_bytes), path)
+        job_id = await job_queue.submit("video", {"path": path})
+
+        return {"message": "Video uploaded successfully", "job_id": job_id}
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+async def save_stream(stream, path):
+    # Write the body to a temp file as it arrives, then move it into place once it is on disk
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            async for chunk in stream:
+                await run_in_threadpool(tmp_file.write, chunk)
+            tmp_file.flush()
+            await run_in_threadpool(os.fsync, tmp_file.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
 
-        with open(f"videos/{data.publish_date}.mp4", "wb") as video_file:
-            video_file.write(video_bytes)
+@app.post("/video/stream")
+async def upload_video_stream(request: Request, description: str, publish_date: int):
+    try:
+        path = f"videos/{publish_date}.mp4"
+        await save_stream(request.stream(), path)
+        job_id = await job_queue.submit("video", {"path": path})
 
-        return {"message": "Video uploaded successfully"}
+        return {"message": "Video uploaded successfully", "job_id": job_id}
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/video/jobs/{job_id}")
+async def get_video_job(job_id: str):
+    job = await job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    del job["payload"]
+    return job
+
+@app.api_route("/video/{publish_date}", methods=["GET", "HEAD"])
+async def get_video(publish_date: int, request: Request):
+    try:
+        return await media_response(request, f"videos/{publish_date}.mp4", "video/mp4", VIDEO_CACHE_CONTROL)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Video not found")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+def session_path(upload_id: str, suffix: str):
+    # Ids are generated by us, refuse anything else so they cannot escape the directory
+    try:
+        uuid.UUID(upload_id)
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    return os.path.join(UPLOADS_DIR, f"{upload_id}{suffix}")
+
+def load_session(upload_id: str):
+    try:
+        with open(session_path(upload_id, ".json")) as session_file:
+            return json.load(session_file)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Upload session not found")
+
+def save_session(session):
+    path = session_path(session["upload_id"], ".json")
+    with open(f"{path}.tmp", "w") as session_file:
+        json.dump(session, session_file)
+    os.replace(f"{path}.tmp", path)
+
+def add_range(ranges, start: int, end: int):
+    # Merge [start, end) into the sorted list of received byte ranges
+    merged = []
+    for range_start, range_end in sorted(ranges + [[start, end]]):
+        if merged and range_start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], range_end)
+        else:
+            merged.append([range_start, range_end])
+    return merged
+
+def contiguous_offset(session):
+    ranges = session["ranges"]
+    return ranges[0][1] if ranges and ranges[0][0] == 0 else 0
+
+def session_status(session):
+    return {
+        "upload_id": session["upload_id"],
+        "offset": contiguous_offset(session),
+        "size": session["size"],
+        "chunks": session["chunks"],
+        "ranges": session["ranges"],
+    }
+
+def write_at(fd: int, offset: int, chunk: bytes):
+    while chunk:
+        written = os.pwrite(fd, chunk, offset)
+        offset += written
+        chunk = chunk[written:]
+
+# Sessions are updated from the event loop only, so one lock keeps chunk bookkeeping consistent
+session_lock = asyncio.Lock()
+
+@app.post("/video/uploads")
+async def create_upload_session(data: UploadSessionCreate):
+    os.makedirs(UPLOADS_DIR, exist_ok=True)
+    session = {
+        "upload_id": str(uuid.uuid4()),
+        "description": data.description,
+        "publish_date": data.publish_date,
+        "size": data.size,
+        "chunks": [],
+        "ranges": [],
+        "updated_at": time.time(),
+    }
+    open(session_path(session["upload_id"], ".part"), "wb").close()
+    save_session(session)
+    return session_status(session)
+
+@app.get("/video/uploads/{upload_id}")
+async def get_upload_session(upload_id: str):
+    return session_status(load_session(upload_id))
+
+# Chunks may arrive in any order and in parallel, each one says where it goes
+@app.put("/video/uploads/{upload_id}/chunks/{index}")
+async def upload_chunk(upload_id: str, index: int, offset: int, request: Request):
+    session = load_session(upload_id)
+    if offset < 0 or (session["size"] is not None and offset > session["size"]):
+        raise HTTPException(status_code=400, detail="Chunk offset out of range")
+
+    fd = os.open(session_path(upload_id, ".part"), os.O_WRONLY)
+    try:
+        position = offset
+        async for chunk in request.stream():
+            await run_in_threadpool(write_at, fd, position, chunk)
+            position += len(chunk)
+    finally:
+        os.close(fd)
+    if session["size"] is not None and position > session["size"]:
+        raise HTTPException(status_code=400, detail="Chunk runs past the declared size")
+
+    async with session_lock:
+        session = load_session(upload_id)
+        session["ranges"] = add_range(session["ranges"], offset, position)
+        if index not in session["chunks"]:
+            session["chunks"] = sorted(session["chunks"] + [index])
+        session["updated_at"] = time.time()
+        save_session(session)
+    return session_status(session)
+
+@app.post("/video/uploads/{upload_id}/complete")
+async def complete_upload_session(upload_id: str):
+    async with session_lock:
+        session = load_session(upload_id)
+        size = session["size"] if session["size"] is not None else contiguous_offset(session)
+        if len(session["ranges"]) != 1 or contiguous_offset(session) != size:
+            raise HTTPException(status_code=409, detail="Upload is missing chunks")
+
+        part_path = session_path(upload_id, ".part")
+        with open(part_path, "r+b") as part_file:
+            part_file.truncate(size)
+            await run_in_threadpool(os.fsync, part_file.fileno())
+        path = f"videos/{session['publish_date']}.mp4"
+        os.replace(part_path, path)
+        os.unlink(session_path(upload_id, ".json"))
+
+    job_id = await job_queue.submit("video", {"path": path})
+    return {"message": "Video uploaded successfully", "size": size, "job_id": job_id}
+
+def collect_stale_sessions():
+    if not os.path.isdir(UPLOADS_DIR):
+        return
+    now = time.time()
+    for name in os.listdir(UPLOADS_DIR):
+        path = os.path.join(UPLOADS_DIR, name)
+        if now - os.path.getmtime(path) > UPLOAD_SESSION_TTL:
+            os.unlink(path)
+
+async def collect_stale_sessions_periodically():
+    while True:
+        try:
+            await run_in_threadpool(collect_stale_sessions)
+        except Exception as e:
+            logger.warning("upload session cleanup failed: %s", e)
+        await asyncio.sleep(UPLOAD_GC_INTERVAL)
+
 async def make_http_request():
     async with httpx.AsyncClient() as client:
         payload = {"service_name": "video_service"}  
@@ -38,11 +298,18 @@ async def make_http_request():
         if response.status_code != 200:
             raise HTTPException(status_code=500, detail=f"Failed to make HTTP request, status code: {response.status_code}")
         
-        print("successfully registered")
+        logger.info("successfully registered")
 
 @app.on_event("startup")
 async def startup_event():
+    os.makedirs("videos", exist_ok=True)
+    await job_queue.start()
     await make_http_request()
+    asyncio.create_task(collect_stale_sessions_periodically())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await job_queue.stop()
 
 if __name__ == "__main__":
     print("urmom") 